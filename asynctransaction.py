@@ -0,0 +1,192 @@
+"""
+Asyncio facade over the concurrency control manager (Python 3 only).
+
+Instead of returning None and being polled through check_lock(), an operation
+that has to wait for a lock suspends on a future, which the transaction that
+releases the lock resolves through the handler's grant callback. A deadlock
+victim's pending and later operations raise TransactionAborted. One event
+loop can so serve many mostly idle transactions without polling:
+
+    coordinator = AsyncTransactionCoordinator(lock_table)
+    coordinator.start()
+    txn = coordinator.transaction(xid, store)
+    try:
+        value = await txn.get('a')
+        await txn.put('a', value + '!')
+        await txn.commit()
+    except TransactionAborted:
+        ...
+
+The coordinator task aborts the victims of detect_all_deadlocks() every
+interval seconds. Transactions aborted by a deadlock prevention policy or a
+lock wait timeout fail right away, through the handler's abort callback.
+"""
+import asyncio
+
+from student import DEADLOCK, USER, TransactionCoordinator, \
+    TransactionHandler, get_lock_manager
+
+class TransactionAborted(Exception):
+    """
+    Raised by the operations of an aborted transaction.
+
+    xid: the transaction's ID.
+    result: what abort() returned, 'Deadlock Abort' or 'User Abort'.
+    """
+
+    def __init__(self, xid, result):
+        Exception.__init__(self, '%s: transaction %s' % (result, xid))
+        self.xid = xid
+        self.result = result
+
+class AsyncTransactionHandler(object):
+    """
+    Runs one transaction through a TransactionHandler, which is available as
+    self.handler. The operations must be awaited one at a time.
+    """
+
+    def __init__(self, lock_table, xid, store, coordinator=None):
+        self.handler = TransactionHandler(lock_table, xid, store)
+        self.handler.set_grant_callback(self._granted)
+        self.handler.set_abort_callback(self._aborted)
+        self._threaded = get_lock_manager(lock_table).threaded
+        self._coordinator = coordinator
+        self._loop = None
+        self._future = None
+        self._error = None
+
+    @property
+    def xid(self):
+        return self.handler._xid
+
+    async def get(self, key):
+        return await self._perform(self.handler.perform_get, key)
+
+    async def get_for_update(self, key):
+        return await self._perform(self.handler.perform_get_for_update, key)
+
+    async def put(self, key, value):
+        return await self._perform(self.handler.perform_put, key, value)
+
+    async def multi_get(self, keys):
+        return await self._perform(self.handler.perform_multi_get, keys)
+
+    async def multi_put(self, items):
+        return await self._perform(self.handler.perform_multi_put, items)
+
+    async def commit(self):
+        """
+        Commits the transaction, or raises TransactionAborted if it was
+        aborted.
+        """
+        if self._error is not None:
+            raise self._error
+        result = self.handler.commit()
+        self._finished()
+        if result != 'Transaction Completed':
+            self._error = TransactionAborted(self.xid, result)
+            raise self._error
+        return result
+
+    async def abort(self, mode=USER):
+        result = self.handler.abort(mode)
+        self._finished()
+        if self._error is None:
+            self._error = TransactionAborted(self.xid, result)
+        return result
+
+    async def _perform(self, method, *args):
+        if self._error is not None:
+            raise self._error
+        #The future exists before the call, as a striped lock manager may
+        #grant the lock from another thread before the call returns
+        self._loop = asyncio.get_running_loop()
+        future = self._future = self._loop.create_future()
+        result = method(*args)
+        if result is not None:
+            self._future = None
+            return result
+        return await future
+
+    def _call_soon(self, callback, *args):
+        if self._threaded:
+            self._loop.call_soon_threadsafe(callback, *args)
+        else:
+            self._loop.call_soon(callback, *args)
+
+    def _granted(self, handler, result):
+        self._call_soon(self._resolve, result)
+
+    def _resolve(self, result):
+        future = self._future
+        self._future = None
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    def _aborted(self, handler):
+        self._call_soon(self.fail)
+
+    def fail(self, mode=DEADLOCK):
+        """
+        Aborts the transaction and fails its pending operation, if any, with
+        TransactionAborted. Must be called from the event loop.
+        """
+        if self._error is not None:
+            return
+        self._error = TransactionAborted(self.xid, self.handler.abort(mode))
+        self._finished()
+        future = self._future
+        self._future = None
+        if future is not None and not future.done():
+            future.set_exception(self._error)
+
+    def _finished(self):
+        if self._coordinator is not None:
+            self._coordinator._handlers.pop(self.xid, None)
+
+class AsyncTransactionCoordinator(object):
+    """
+    Creates the AsyncTransactionHandlers of a lock table and aborts the
+    deadlock victims among them from a background task.
+    """
+
+    def __init__(self, lock_table, interval=0.05, victim_policy=None):
+        self._lock_table = lock_table
+        self._coordinator = TransactionCoordinator(lock_table, victim_policy)
+        self._interval = interval
+        self._handlers = {}
+        self._task = None
+
+    def transaction(self, xid, store):
+        handler = AsyncTransactionHandler(self._lock_table, xid, store, self)
+        self._handlers[xid] = handler
+        return handler
+
+    def detect_deadlocks(self):
+        """
+        Aborts the victims of one deadlock check and returns their xids.
+        """
+        victims = self._coordinator.detect_all_deadlocks()
+        for xid in victims:
+            handler = self._handlers.get(xid)
+            if handler is not None:
+                handler.fail(DEADLOCK)
+        return victims
+
+    async def run(self):
+        while True:
+            self.detect_deadlocks()
+            await asyncio.sleep(self._interval)
+
+    def start(self):
+        """
+        Starts checking for deadlocks in a task of the running event loop.
+        """
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,384 @@
+"""
+In-process benchmark of the concurrency control manager.
+
+Drives simulated clients against TransactionHandler and TransactionCoordinator
+the way the server does, without sockets: every round, each client issues its
+next operation or polls check_lock() if it is blocked, and every
+--deadlock-interval rounds the coordinator's deadlock victims are aborted and
+restarted. Reports throughput, abort rate, lock wait percentiles and the cost
+of detect_deadlocks() as a function of the lock table size.
+
+    $ python benchmark.py --clients 32 --skew 0.99 --read-ratio 0.8
+    $ python benchmark.py --store dbm --sweep 100,1000,10000
+"""
+from __future__ import print_function
+
+import argparse
+import bisect
+import os
+import random
+import shutil
+import tempfile
+
+from timeit import default_timer
+
+import student
+
+from kvstore import DBMStore, InMemoryKVStore
+from student import DEADLOCK, TransactionCoordinator, TransactionHandler, \
+    forget_lock_manager
+
+class ZipfianKeys(object):
+    """
+    Draws keys out of @count keys, the i-th most popular one with probability
+    proportional to 1 / i ** @skew. A skew of 0 is uniform.
+    """
+
+    def __init__(self, count, skew, rnd):
+        self._rnd = rnd
+        self._keys = ['k%d' % i for i in range(count)]
+        self._cumulative = []
+        total = 0.0
+        for i in range(1, count + 1):
+            total += 1.0 / i ** skew
+            self._cumulative.append(total)
+        self._total = total
+
+    def next(self):
+        point = self._rnd.random() * self._total
+        return self._keys[bisect.bisect_left(self._cumulative, point)]
+
+class _Client(object):
+    """
+    A simulated client, running one transaction at a time and restarting it
+    with a new xid whenever it is aborted as a deadlock victim.
+    """
+
+    def __init__(self, bench):
+        self._bench = bench
+        self.handler = None
+        self._ops = None
+        self._position = 0
+        self._blockedSince = None
+        self._restarts = 0
+
+    def begin(self, ops):
+        bench = self._bench
+        self.handler = TransactionHandler(bench.lock_table, bench.next_xid(),
+                                          bench.store)
+        self.handler._restarts = self._restarts
+        self._ops = ops
+        self._position = 0
+        self._blockedSince = None
+        bench.clients[self.handler._xid] = self
+
+    def step(self):
+        """
+        Issues the next operation of the transaction, or polls the one it is
+        blocked on. Returns False once the client has nothing left to do.
+        """
+        bench = self._bench
+        handler = self.handler
+        if handler is None:
+            return False
+        if self._blockedSince is not None:
+            if handler.check_lock() is None:
+                return True
+            bench.waits.append(default_timer() - self._blockedSince)
+            self._blockedSince = None
+            self._done_op()
+            return True
+        if self._position == len(self._ops):
+            del bench.clients[handler._xid]
+            if handler.commit() == 'Transaction Completed':
+                bench.committed += 1
+                self._restarts = 0
+                self._next_transaction()
+            else:
+                self._restart()
+            return True
+        op, key = self._ops[self._position]
+        if op == 'GET':
+            result = handler.perform_get(key)
+        elif op == 'GET_FOR_UPDATE':
+            result = handler.perform_get_for_update(key)
+        else:
+            result = handler.perform_put(key, str(handler._xid))
+        if result is None:
+            self._blockedSince = default_timer()
+        else:
+            self._done_op()
+        return True
+
+    def _done_op(self):
+        self._bench.operations += 1
+        self._position += 1
+
+    def abort(self):
+        del self._bench.clients[self.handler._xid]
+        self.handler.abort(DEADLOCK)
+        self._restart()
+
+    def _restart(self):
+        self._bench.aborted += 1
+        self._restarts += 1
+        self.begin(self._ops)
+
+    def _next_transaction(self):
+        ops = self._bench.new_transaction()
+        if ops is None:
+            self.handler = None
+        else:
+            self.begin(ops)
+
+class Benchmark(object):
+    """
+    One run of the workload described by the parsed command line @options.
+    """
+
+    def __init__(self, options, store):
+        self.options = options
+        self.store = store
+        self.lock_table = {}
+        self.coordinator = TransactionCoordinator(self.lock_table)
+        self._rnd = random.Random(options.seed)
+        self._keys = ZipfianKeys(options.keys, options.skew, self._rnd)
+        self._xid = 0
+        self._started = 0
+        self.clients = {}
+        self.committed = 0
+        self.aborted = 0
+        self.operations = 0
+        self.waits = []
+        self.detections = []
+
+    def next_xid(self):
+        self._xid += 1
+        return self._xid
+
+    def new_transaction(self):
+        """
+        Returns the (@op, @key) operations of the next transaction, or None
+        once all transactions have been started. A write goes to a key the
+        transaction has read before, upgrading its lock, with probability
+        --upgrade-ratio. With --update-locks, the read of such a key takes an
+        update lock.
+        """
+        options = self.options
+        if self._started == options.transactions:
+            return None
+        self._started += 1
+        rnd = self._rnd
+        ops = []
+        reads = []
+        for i in range(options.length):
+            if rnd.random() < options.read_ratio:
+                key = self._keys.next()
+                reads.append(key)
+                ops.append(('GET', key))
+            elif reads and rnd.random() < options.upgrade_ratio:
+                key = rnd.choice(reads)
+                if options.update_locks:
+                    ops = [('GET_FOR_UPDATE', k) if (o, k) == ('GET', key)
+                           else (o, k) for o, k in ops]
+                ops.append(('PUT', key))
+            else:
+                ops.append(('PUT', self._keys.next()))
+        return ops
+
+    def run(self):
+        """
+        Runs the workload to completion and returns its measurements, see
+        report().
+        """
+        options = self.options
+        clients = [_Client(self) for i in range(options.clients)]
+        for client in clients:
+            client._next_transaction()
+        started = default_timer()
+        rounds = 0
+        busy = True
+        while busy:
+            busy = False
+            for client in clients:
+                if client.step():
+                    busy = True
+            rounds += 1
+            if rounds % options.deadlock_interval == 0 or not busy:
+                self._break_deadlocks()
+        elapsed = default_timer() - started
+        forget_lock_manager(self.lock_table)
+        return self._results(elapsed)
+
+    def _break_deadlocks(self):
+        coordinator = self.coordinator
+        while True:
+            size = coordinator.live_lock_entries()
+            started = default_timer()
+            victims = coordinator.detect_all_deadlocks()
+            self.detections.append((size, default_timer() - started))
+            if not victims:
+                return
+            for xid in victims:
+                client = self.clients.get(xid)
+                if client is not None:
+                    client.abort()
+
+    def _results(self, elapsed):
+        finished = self.committed + self.aborted
+        return {
+            'elapsed': elapsed,
+            'ops_per_sec': self.operations / elapsed,
+            'commits_per_sec': self.committed / elapsed,
+            'abort_rate': float(self.aborted) / finished if finished else 0.0,
+            'wait_p50': percentile(self.waits, 0.50),
+            'wait_p99': percentile(self.waits, 0.99),
+            'blocked_ops': len(self.waits),
+            'detect_cost': detection_cost_by_size(self.detections),
+        }
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[int(fraction * (len(ordered) - 1))]
+
+def detection_cost_by_size(detections):
+    """
+    Groups (@size, @seconds) samples of detect_deadlocks() by lock table size,
+    in powers of two, and returns the sorted (@size, @calls, @mean seconds)
+    of each group.
+    """
+    groups = {}
+    for size, seconds in detections:
+        bucket = 1
+        while bucket < size:
+            bucket *= 2
+        calls, total = groups.get(bucket, (0, 0.0))
+        groups[bucket] = (calls + 1, total + seconds)
+    return [(bucket, calls, total / calls)
+            for bucket, (calls, total) in sorted(groups.items())]
+
+def sweep_detection(store, sizes, waitersPerKey=1, repeat=5):
+    """
+    Measures detect_deadlocks() on lock tables of the given @sizes: each key
+    is locked exclusively by its own transaction, and @waitersPerKey more
+    transactions wait for it, so the waits-for graph has one edge per waiter
+    and no cycle.
+
+    @return: a list of (@size, @first call seconds, @repeated call seconds),
+    the first call after the waits were queued, and the mean of @repeat
+    calls with no change in between.
+    """
+    results = []
+    for size in sizes:
+        lockTable = {}
+        coordinator = TransactionCoordinator(lockTable)
+        xid = 0
+        handlers = []
+        for i in range(size):
+            xid += 1
+            holder = TransactionHandler(lockTable, xid, store)
+            holder.perform_put('sweep%d' % i, 'v')
+            handlers.append(holder)
+        for i in range(size):
+            for j in range(waitersPerKey):
+                xid += 1
+                waiter = TransactionHandler(lockTable, xid, store)
+                waiter.perform_get('sweep%d' % i)
+                handlers.append(waiter)
+        started = default_timer()
+        coordinator.detect_all_deadlocks()
+        first = default_timer() - started
+        started = default_timer()
+        for i in range(repeat):
+            coordinator.detect_all_deadlocks()
+        repeated = (default_timer() - started) / repeat
+        for handler in handlers:
+            handler.abort(DEADLOCK)
+        forget_lock_manager(lockTable)
+        results.append((size, first, repeated))
+    return results
+
+def report(results):
+    print('elapsed            %.3f s' % results['elapsed'])
+    print('throughput         %.0f ops/s, %.0f commits/s'
+          % (results['ops_per_sec'], results['commits_per_sec']))
+    print('abort rate         %.2f%%' % (100 * results['abort_rate']))
+    print('lock wait p50/p99  %.3f / %.3f ms (%d blocked operations)'
+          % (1000 * results['wait_p50'], 1000 * results['wait_p99'],
+             results['blocked_ops']))
+    print('detect_deadlocks   lock table size <=, calls, mean us')
+    for size, calls, seconds in results['detect_cost']:
+        print('                   %8d %8d %10.1f' % (size, calls,
+                                                    1e6 * seconds))
+
+def make_store(kind, workdir):
+    if kind == 'memory':
+        return InMemoryKVStore()
+    #The DBM store creates its database file in the current directory
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        return DBMStore()
+    finally:
+        os.chdir(cwd)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='In-process benchmark of the concurrency control manager.')
+    parser.add_argument('--store', choices=['memory', 'dbm'],
+                        default='memory')
+    parser.add_argument('--transactions', type=int, default=2000,
+                        help='transactions to commit (default: %(default)s)')
+    parser.add_argument('--clients', type=int, default=16,
+                        help='concurrent transactions (default: %(default)s)')
+    parser.add_argument('--keys', type=int, default=1000,
+                        help='number of distinct keys (default: %(default)s)')
+    parser.add_argument('--skew', type=float, default=0.99,
+                        help='Zipfian skew of the key accesses, 0 for '
+                        'uniform (default: %(default)s)')
+    parser.add_argument('--length', type=int, default=8,
+                        help='operations per transaction '
+                        '(default: %(default)s)')
+    parser.add_argument('--read-ratio', type=float, default=0.8,
+                        help='fraction of GETs (default: %(default)s)')
+    parser.add_argument('--upgrade-ratio', type=float, default=0.5,
+                        help='fraction of PUTs to a key the transaction has '
+                        'read (default: %(default)s)')
+    parser.add_argument('--update-locks', action='store_true',
+                        help='read the keys that are written later with '
+                        'update locks')
+    parser.add_argument('--deadlock-interval', type=int, default=10,
+                        help='rounds between deadlock checks '
+                        '(default: %(default)s)')
+    parser.add_argument('--prevention', default=None,
+                        choices=[student.NO_WAIT, student.WAIT_DIE,
+                                 student.WOUND_WAIT],
+                        help='deadlock prevention policy instead of '
+                        'detection')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sweep', default=None, metavar='SIZES',
+                        help='instead of the workload, time detect_deadlocks '
+                        'on lock tables of these comma-separated sizes')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    student.DEADLOCK_PREVENTION = options.prevention
+    workdir = tempfile.mkdtemp()
+    try:
+        store = make_store(options.store, workdir)
+        if options.sweep:
+            sizes = [int(size) for size in options.sweep.split(',')]
+            print('lock table size, first detect_deadlocks us, repeated us')
+            for size, first, repeated in sweep_detection(store, sizes):
+                print('%8d %12.1f %12.1f' % (size, 1e6 * first,
+                                             1e6 * repeated))
+        else:
+            report(Benchmark(options, store).run())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
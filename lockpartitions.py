@@ -0,0 +1,340 @@
+"""
+Partitioned lock management across processes.
+
+The keyspace is hash-partitioned across several local processes, each
+running the lock manager of student.py over its own lock table and its own
+store for the keys of its partition, so that lock management can use more
+than one core. They are driven over multiprocessing pipes:
+
+    partitions = LockPartitions(4)
+    coordinator = PartitionedTransactionCoordinator(partitions)
+    handler = partitions.handler(xid)
+    handler.perform_put('a', '1')
+    ...
+    partitions.close()
+
+PartitionedTransactionHandler offers the TransactionHandler interface for
+single-key operations: every operation goes to the partition of its key,
+where the transaction has a branch with its locks, and commit() commits all
+the branches in two phases. PartitionedTransactionCoordinator merges the
+waits-for graphs of all partitions, so that it also finds the deadlocks that
+span partitions.
+
+Requests to different partitions can be in flight at the same time: a server
+can drive the partitions from several threads, and commits, aborts and
+deadlock checks that involve several partitions send to all of them before
+waiting for any reply.
+"""
+import multiprocessing
+import threading
+import zlib
+
+import student
+
+from kvstore import InMemoryKVStore
+from student import DEADLOCK, USER, TransactionCoordinator, \
+    TransactionHandler, find_deadlocked_components
+
+"""
+The student.py settings that the partition processes take from the parent
+when they start, unless overridden.
+"""
+_SHARED_SETTINGS = ('DEADLOCK_VICTIM_POLICY', 'DEADLOCK_PREVENTION',
+                    'LOCK_ENTRY_POOL_SIZE', 'LOCK_PARTITIONS',
+                    'LOCK_PARTITION_SEPARATOR', 'LOCK_ESCALATION_THRESHOLD',
+                    'DEFERRED_WRITES', 'LOCK_STATS', 'LOCK_WAIT_BUCKETS',
+                    'LOCK_WAIT_TIMEOUT')
+
+"""
+The TransactionHandler methods a partition runs on behalf of a transaction.
+"""
+_OPERATIONS = frozenset(['perform_get', 'perform_put',
+                         'perform_get_for_update', 'check_lock'])
+
+def _serve_partition(conn, store_factory, settings):
+    """
+    The main loop of a partition process: runs the requests received on
+    @conn against the partition's lock manager and store, one at a time, and
+    sends back their results.
+    """
+    for name, value in settings.items():
+        setattr(student, name, value)
+    #One thread serves the partition
+    student.LOCK_STRIPES = 0
+    store = store_factory()
+    lockTable = {}
+    coordinator = TransactionCoordinator(lockTable)
+    handlers = {}
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        op = request[0]
+        if op == 'stop':
+            conn.send(None)
+            break
+        if op == 'op':
+            xid, method, args = request[1:]
+            if method not in _OPERATIONS:
+                conn.send(ValueError('unknown operation %r' % (method,)))
+                continue
+            handler = handlers.get(xid)
+            if handler is None:
+                if method == 'check_lock':
+                    conn.send(None)
+                    continue
+                handler = handlers[xid] = TransactionHandler(lockTable, xid,
+                                                             store)
+            conn.send(getattr(handler, method)(*args))
+        elif op == 'prepare':
+            handler = handlers.get(request[1])
+            conn.send(handler is None or handler.prepare())
+        elif op == 'commit':
+            handler = handlers.pop(request[1], None)
+            if handler is None:
+                conn.send('Transaction Completed')
+            else:
+                conn.send(handler.commit())
+        elif op == 'abort':
+            xid, mode = request[1:]
+            handler = handlers.pop(xid, None)
+            if handler is None:
+                handler = TransactionHandler(lockTable, xid, store)
+            conn.send(handler.abort(mode))
+        elif op == 'deadlock_state':
+            #The local victims include the transactions aborted by the
+            #prevention policy or a lock wait timeout
+            victims = coordinator.detect_all_deadlocks()
+            conn.send((coordinator.waits_for_edges(), list(victims)))
+        elif op == 'lock_stats':
+            conn.send(coordinator.lock_stats(*request[1:]))
+        else:
+            conn.send(ValueError('unknown request %r' % (op,)))
+
+class LockPartitions(object):
+    """
+    Starts @count partition processes, each with a store made by
+    @store_factory (which must be picklable) and the student.py settings of
+    the parent, updated with @settings.
+    """
+
+    def __init__(self, count, store_factory=InMemoryKVStore, settings=None):
+        shared = dict((name, getattr(student, name))
+                      for name in _SHARED_SETTINGS)
+        if settings:
+            shared.update(settings)
+        self._conns = []
+        self._processes = []
+        self._mutexes = []
+        for i in range(count):
+            parentConn, childConn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_serve_partition,
+                args=(childConn, store_factory, shared))
+            process.daemon = True
+            process.start()
+            childConn.close()
+            self._conns.append(parentConn)
+            self._processes.append(process)
+            self._mutexes.append(threading.Lock())
+
+    def __len__(self):
+        return len(self._conns)
+
+    def partition_of(self, key):
+        """
+        Returns the index of the partition of @key. The hash is stable across
+        processes and runs, unlike hash().
+        """
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return (zlib.crc32(key) & 0xffffffff) % len(self._conns)
+
+    def handler(self, xid):
+        return PartitionedTransactionHandler(self, xid)
+
+    def call(self, index, request):
+        """
+        Sends @request to partition @index and returns its reply.
+        """
+        with self._mutexes[index]:
+            self._conns[index].send(request)
+            return self._conns[index].recv()
+
+    def broadcast(self, indices, request):
+        """
+        Sends @request to all the partitions in @indices before waiting for
+        their replies, so that they process it in parallel.
+
+        @return: a dict mapping each index to the partition's reply.
+        """
+        indices = sorted(indices)
+        for index in indices:
+            self._mutexes[index].acquire()
+        try:
+            for index in indices:
+                self._conns[index].send(request)
+            return dict((index, self._conns[index].recv())
+                        for index in indices)
+        finally:
+            for index in reversed(indices):
+                self._mutexes[index].release()
+
+    def close(self):
+        self.broadcast(range(len(self._conns)), ('stop',))
+        for conn, process in zip(self._conns, self._processes):
+            conn.close()
+            process.join()
+
+class PartitionedTransactionHandler(object):
+    """
+    A transaction over partitioned lock managers, with the TransactionHandler
+    interface for single-key operations. It has a branch in every partition
+    it accessed a key of, and waits in at most one of them at a time.
+    """
+
+    def __init__(self, partitions, xid):
+        self._partitions = partitions
+        self._xid = xid
+        self._branches = set()
+        self._waiting = None
+
+    def perform_get(self, key):
+        return self._perform(key, 'perform_get', (key,))
+
+    def perform_get_for_update(self, key):
+        return self._perform(key, 'perform_get_for_update', (key,))
+
+    def perform_put(self, key, value):
+        return self._perform(key, 'perform_put', (key, value))
+
+    def _perform(self, key, method, args):
+        index = self._partitions.partition_of(key)
+        self._branches.add(index)
+        result = self._partitions.call(index, ('op', self._xid, method, args))
+        if result is None:
+            self._waiting = index
+        return result
+
+    def check_lock(self):
+        if self._waiting is None:
+            return None
+        result = self._partitions.call(self._waiting,
+                                       ('op', self._xid, 'check_lock', ()))
+        if result is not None:
+            self._waiting = None
+        return result
+
+    def commit(self):
+        """
+        Commits every branch of the transaction, unless a partition has
+        aborted its branch, in which case all of them are aborted.
+
+        @return: 'Transaction Completed' or 'Deadlock Abort'.
+        """
+        partitions = self._partitions
+        branches = self._branches
+        if len(branches) > 1:
+            prepared = partitions.broadcast(branches, ('prepare', self._xid))
+            if not all(prepared.values()):
+                return self.abort(DEADLOCK)
+        results = partitions.broadcast(branches, ('commit', self._xid))
+        self._finish()
+        for result in results.values():
+            if result != 'Transaction Completed':
+                return result
+        return 'Transaction Completed'
+
+    def abort(self, mode):
+        self._partitions.broadcast(self._branches,
+                                   ('abort', self._xid, mode))
+        self._finish()
+        if (mode == USER):
+            return 'User Abort'
+        else:
+            return 'Deadlock Abort'
+
+    def _finish(self):
+        self._branches = set()
+        self._waiting = None
+
+class PartitionedTransactionCoordinator(object):
+    """
+    Finds the deadlocks of the transactions of LockPartitions @partitions,
+    including those that span partitions.
+    """
+
+    def __init__(self, partitions):
+        self._partitions = partitions
+
+    def _deadlock_state(self):
+        """
+        Collects the waits-for graphs of all partitions, merged into one, and
+        the victims the partitions picked themselves. A transaction waits in
+        one partition at a time, so its edges all come from that partition.
+        """
+        partitions = self._partitions
+        states = partitions.broadcast(range(len(partitions)),
+                                      ('deadlock_state',))
+        edges = {}
+        victims = set()
+        for partitionEdges, partitionVictims in states.values():
+            edges.update(partitionEdges)
+            victims.update(partitionVictims)
+        return edges, victims
+
+    def detect_all_deadlocks(self):
+        """
+        Picks one transaction to abort in every deadlocked set of
+        transactions, across all partitions. A cycle within one partition is
+        broken by the victim that partition picks by its victim policy; one
+        that spans partitions by aborting its youngest transaction.
+
+        The partitions' graphs are read one after the other, so a cycle is
+        only reported if it is still there when they are read again.
+
+        @param self: the partitioned transaction coordinator.
+
+        @return: a sorted list of the xids to abort.
+        """
+        edges, victims = self._deadlock_state()
+        components = find_deadlocked_components(edges, sorted(edges))
+        if components:
+            confirmedEdges, confirmedVictims = self._deadlock_state()
+            victims.update(confirmedVictims)
+            members = set(xid for component in components
+                          for xid in component)
+            stable = {}
+            for xid in members:
+                if xid in confirmedEdges:
+                    stable[xid] = [g for g in confirmedEdges[xid]
+                                   if g in members and g in edges[xid]]
+            components = find_deadlocked_components(stable, sorted(stable))
+        for component in components:
+            if victims.isdisjoint(component):
+                victims.add(max(component))
+        return sorted(victims)
+
+    def detect_deadlocks(self):
+        """
+        Returns the xid of a transaction to abort, or None if there are no
+        deadlocks, see TransactionCoordinator.detect_deadlocks().
+        """
+        victims = self.detect_all_deadlocks()
+        if victims:
+            return victims[0]
+        return None
+
+    def lock_stats(self, reset=False):
+        """
+        Returns the contention statistics of all partitions, see
+        TransactionCoordinator.lock_stats().
+        """
+        partitions = self._partitions
+        stats = {}
+        for partitionStats in partitions.broadcast(range(len(partitions)),
+                                                   ('lock_stats',
+                                                    reset)).values():
+            stats.update(partitionStats)
+        return stats
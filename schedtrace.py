@@ -0,0 +1,469 @@
+"""
+Schedule traces: records the calls the server makes into the concurrency
+control manager, in the order they complete and with their timings, to a
+compact binary file, and replays them deterministically against a fresh lock
+manager, so that a production schedule can be reproduced, profiled and tuned
+offline.
+
+Recording is opt-in and costs nothing until install() is called:
+
+    recorder = schedtrace.install('kvs.trace')
+    ...
+    schedtrace.uninstall()
+
+    $ python schedtrace.py kvs.trace           # replay and summarize
+    $ python schedtrace.py --dump kvs.trace    # print the records
+
+A trace starts with a header (MAGIC, VERSION). Every record then has a fixed
+RECORD part (op, flags, xid, start time in seconds since the recorder was
+created, duration in seconds) followed by the op's arguments: keys and values
+as length-prefixed UTF-8 strings, lists as a count followed by their items,
+abort modes as a byte.
+Keys and values must be strings. A call whose record cannot be packed, e.g.
+because an argument is not a string, is not recorded and counted as dropped.
+"""
+from __future__ import print_function
+
+import argparse
+import struct
+import threading
+
+from collections import namedtuple
+from timeit import default_timer
+
+import student
+
+from kvstore import InMemoryKVStore
+from student import DEADLOCK, USER, TransactionCoordinator, \
+    TransactionHandler, forget_lock_manager
+
+MAGIC = b'KVST'
+VERSION = 2
+HEADER = struct.Struct('<4sH')
+RECORD = struct.Struct('<BBQdf')
+COUNT = struct.Struct('<I')
+XID = struct.Struct('<Q')
+MODE = struct.Struct('<B')
+
+"""
+Record ops.
+"""
+BEGIN = 1
+GET = 2
+PUT = 3
+MULTI_GET = 4
+MULTI_PUT = 5
+COMMIT = 6
+USER_ABORT = 7
+DEADLOCK_ABORT = 8
+GRANTED = 9
+DETECT = 10
+SNAPSHOT = 11
+GET_FOR_UPDATE = 12
+GROUP_RELEASE = 13
+
+OP_NAMES = {
+    BEGIN: 'BEGIN', GET: 'GET', PUT: 'PUT', MULTI_GET: 'MULTI_GET',
+    MULTI_PUT: 'MULTI_PUT', COMMIT: 'COMMIT', USER_ABORT: 'USER_ABORT',
+    DEADLOCK_ABORT: 'DEADLOCK_ABORT', GRANTED: 'GRANTED', DETECT: 'DETECT',
+    SNAPSHOT: 'SNAPSHOT', GET_FOR_UPDATE: 'GET_FOR_UPDATE',
+    GROUP_RELEASE: 'GROUP_RELEASE',
+}
+
+"""
+Record flags. BLOCKED: the call returned None, i.e. the operation is waiting
+for a lock.
+"""
+BLOCKED = 1
+
+TraceRecord = namedtuple('TraceRecord',
+                         'op flags xid start duration args')
+
+def _pack_string(s):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return COUNT.pack(len(s)) + s
+
+def _pack_xids(xids):
+    return COUNT.pack(len(xids)) + b''.join(XID.pack(xid) for xid in xids)
+
+def _pack_args(op, args):
+    if op in (GET, PUT, GET_FOR_UPDATE):
+        return b''.join(_pack_string(s) for s in args)
+    if op == MULTI_GET:
+        keys = args[0]
+        return COUNT.pack(len(keys)) + b''.join(_pack_string(key)
+                                                for key in keys)
+    if op == MULTI_PUT:
+        items = args[0]
+        return COUNT.pack(len(items)) + b''.join(
+            _pack_string(key) + _pack_string(value) for key, value in items)
+    if op == DETECT:
+        return _pack_xids(args[0])
+    if op == GROUP_RELEASE:
+        commits, aborts, mode = args
+        return _pack_xids(commits) + _pack_xids(aborts) + MODE.pack(mode)
+    return b''
+
+class TraceRecorder(object):
+    """
+    Appends records to the trace file at @path. Safe to share between
+    threads; the records are written in the order the calls complete.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION))
+        self._mutex = threading.Lock()
+        self._started = default_timer()
+        self.local = threading.local()
+        self.dropped = 0
+
+    def record(self, op, xid, start, duration, args=(), flags=0):
+        """
+        Appends a record, or counts it in self.dropped if it cannot be packed:
+        the traced call has already run, and must return its result anyway.
+        """
+        try:
+            data = (RECORD.pack(op, flags, xid, start - self._started,
+                                duration)
+                    + _pack_args(op, args))
+        except (struct.error, TypeError, ValueError, AttributeError):
+            with self._mutex:
+                self.dropped += 1
+            return
+        with self._mutex:
+            self._file.write(data)
+
+    def close(self):
+        with self._mutex:
+            self._file.close()
+
+class _TraceReader(object):
+
+    def __init__(self, data):
+        self._data = data
+        self._offset = 0
+
+    def unpack(self, fmt):
+        values = fmt.unpack_from(self._data, self._offset)
+        self._offset += fmt.size
+        return values
+
+    def string(self):
+        length, = self.unpack(COUNT)
+        s = self._data[self._offset:self._offset + length]
+        self._offset += length
+        if bytes is str:
+            return s
+        return s.decode('utf-8')
+
+    def xids(self):
+        count, = self.unpack(COUNT)
+        return [self.unpack(XID)[0] for i in range(count)]
+
+    def args(self, op):
+        if op in (GET, GET_FOR_UPDATE):
+            return (self.string(),)
+        if op == PUT:
+            return (self.string(), self.string())
+        if op == MULTI_GET:
+            count, = self.unpack(COUNT)
+            return ([self.string() for i in range(count)],)
+        if op == MULTI_PUT:
+            count, = self.unpack(COUNT)
+            return ([(self.string(), self.string()) for i in range(count)],)
+        if op == DETECT:
+            return (self.xids(),)
+        if op == GROUP_RELEASE:
+            return (self.xids(), self.xids(), self.unpack(MODE)[0])
+        return ()
+
+    def done(self):
+        return self._offset >= len(self._data)
+
+def read_trace(path):
+    """
+    Yields the TraceRecords of the trace file at @path, in order.
+    """
+    with open(path, 'rb') as f:
+        reader = _TraceReader(f.read())
+    magic, version = reader.unpack(HEADER)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('%s is not a version %d schedule trace'
+                         % (path, VERSION))
+    while not reader.done():
+        op, flags, xid, start, duration = reader.unpack(RECORD)
+        yield TraceRecord(op, flags, xid, start, duration, reader.args(op))
+
+"""
+The recorder wraps the methods below while it is installed. An operation that
+was blocked is performed again from within the call that granted its lock; a
+thread-local flag keeps such nested calls out of the trace.
+"""
+_recorder = None
+_originals = {}
+
+def _traced(method, op):
+    def traced(self, *args):
+        local = _recorder.local
+        if getattr(local, 'active', False):
+            return method(self, *args)
+        local.active = True
+        start = default_timer()
+        try:
+            result = method(self, *args)
+        finally:
+            local.active = False
+        duration = default_timer() - start
+        if op == DETECT:
+            args = (self._last_victims,)
+            xid = 0
+        else:
+            xid = self._xid
+        if op == GRANTED and result is None:
+            return result
+        _recorder.record(op, xid, start, duration, args,
+                         BLOCKED if result is None else 0)
+        return result
+    return traced
+
+def _traced_init(method):
+    def traced(self, lock_table, xid, store):
+        start = default_timer()
+        method(self, lock_table, xid, store)
+        _recorder.record(BEGIN, xid, start, default_timer() - start)
+    return traced
+
+def _traced_abort(method):
+    def traced(self, mode):
+        local = _recorder.local
+        if getattr(local, 'active', False):
+            return method(self, mode)
+        local.active = True
+        start = default_timer()
+        try:
+            result = method(self, mode)
+        finally:
+            local.active = False
+        if mode == USER:
+            op = USER_ABORT
+        else:
+            op = DEADLOCK_ABORT
+        _recorder.record(op, self._xid, start, default_timer() - start)
+        return result
+    return traced
+
+def _traced_group_release(method):
+    def traced(self, commits=(), aborts=(), mode=USER):
+        local = _recorder.local
+        if getattr(local, 'active', False):
+            return method(self, commits, aborts, mode)
+        local.active = True
+        start = default_timer()
+        try:
+            result = method(self, commits, aborts, mode)
+        finally:
+            local.active = False
+        _recorder.record(GROUP_RELEASE, 0, start, default_timer() - start,
+                         ([handler._xid for handler in commits],
+                          [handler._xid for handler in aborts], mode))
+        return result
+    return traced
+
+def _traced_detect(method):
+    def traced(self):
+        victims = method(self)
+        self._last_victims = victims
+        return victims
+    return traced
+
+_TRACED_METHODS = [
+    (TransactionHandler, 'perform_get', GET),
+    (TransactionHandler, 'perform_put', PUT),
+    (TransactionHandler, 'perform_get_for_update', GET_FOR_UPDATE),
+    (TransactionHandler, 'perform_multi_get', MULTI_GET),
+    (TransactionHandler, 'perform_multi_put', MULTI_PUT),
+    (TransactionHandler, 'commit', COMMIT),
+    (TransactionHandler, 'check_lock', GRANTED),
+    (TransactionHandler, 'begin_snapshot', SNAPSHOT),
+    (TransactionCoordinator, 'detect_all_deadlocks', DETECT),
+]
+
+def install(path):
+    """
+    Starts recording every TransactionHandler and TransactionCoordinator
+    call to a new trace file at @path.
+
+    @return: the TraceRecorder.
+    """
+    global _recorder
+    if _recorder is not None:
+        uninstall()
+    _recorder = TraceRecorder(path)
+    wrappers = [(TransactionHandler, '__init__',
+                 _traced_init(TransactionHandler.__init__)),
+                (TransactionHandler, 'abort',
+                 _traced_abort(TransactionHandler.abort)),
+                (TransactionCoordinator, 'group_release',
+                 _traced_group_release(TransactionCoordinator.group_release))]
+    for cls, name, op in _TRACED_METHODS:
+        method = getattr(cls, name)
+        if op == DETECT:
+            method = _traced_detect(method)
+        wrappers.append((cls, name, _traced(method, op)))
+    for cls, name, wrapper in wrappers:
+        _originals[(cls, name)] = cls.__dict__[name]
+        setattr(cls, name, wrapper)
+    return _recorder
+
+def uninstall():
+    """
+    Stops recording and closes the trace file.
+    """
+    global _recorder
+    for (cls, name), method in _originals.items():
+        setattr(cls, name, method)
+    _originals.clear()
+    if _recorder is not None:
+        _recorder.close()
+        _recorder = None
+
+class ReplayResult(object):
+    """
+    The outcome of a replay.
+
+    records: the number of records replayed.
+    divergences: (@index, @record, @message) for every call that did not
+    behave as recorded: blocked or returned where it had not, or found other
+    deadlock victims.
+    recorded, replayed: map each op to the total time spent in its calls,
+    in the trace and during the replay.
+    """
+
+    def __init__(self):
+        self.records = 0
+        self.divergences = []
+        self.recorded = {}
+        self.replayed = {}
+
+def replay(path, store=None):
+    """
+    Re-runs the trace at @path, call by call in the recorded order, against
+    a fresh lock table and @store (an empty InMemoryKVStore by default). The
+    replay is single-threaded and deterministic, so the lock manager can be
+    profiled and tuned against the same schedule over and over.
+
+    @return: a ReplayResult.
+    """
+    if store is None:
+        store = InMemoryKVStore()
+    lockTable = {}
+    coordinator = TransactionCoordinator(lockTable)
+    handlers = {}
+    result = ReplayResult()
+    for index, record in enumerate(read_trace(path)):
+        op = record.op
+        handler = handlers.get(record.xid)
+        start = default_timer()
+        if op == BEGIN:
+            handlers[record.xid] = TransactionHandler(lockTable, record.xid,
+                                                      store)
+            returned = True
+        elif op == DETECT:
+            returned = coordinator.detect_all_deadlocks()
+        elif op == GROUP_RELEASE:
+            commits, aborts, mode = record.args
+            missing = [xid for xid in commits + aborts if xid not in handlers]
+            if missing:
+                result.divergences.append(
+                    (index, record, 'unknown transactions %s' % missing))
+                continue
+            returned = coordinator.group_release(
+                [handlers[xid] for xid in commits],
+                [handlers[xid] for xid in aborts], mode)
+        elif handler is None:
+            result.divergences.append((index, record, 'unknown transaction'))
+            continue
+        elif (op in (GET, PUT, GET_FOR_UPDATE, MULTI_GET, MULTI_PUT)
+              and handler._desired_lock is not None):
+            #Only possible if the replay diverged before
+            result.divergences.append((index, record, 'still waiting'))
+            continue
+        elif op == GET:
+            returned = handler.perform_get(*record.args)
+        elif op == PUT:
+            returned = handler.perform_put(*record.args)
+        elif op == GET_FOR_UPDATE:
+            returned = handler.perform_get_for_update(*record.args)
+        elif op == MULTI_GET:
+            returned = handler.perform_multi_get(*record.args)
+        elif op == MULTI_PUT:
+            returned = handler.perform_multi_put(*record.args)
+        elif op == COMMIT:
+            returned = handler.commit()
+        elif op == USER_ABORT:
+            returned = handler.abort(USER)
+        elif op == DEADLOCK_ABORT:
+            returned = handler.abort(DEADLOCK)
+        elif op == GRANTED:
+            returned = handler.check_lock()
+        elif op == SNAPSHOT:
+            returned = handler.begin_snapshot()
+        else:
+            raise ValueError('unknown op %d in record %d' % (op, index))
+        elapsed = default_timer() - start
+        result.records += 1
+        result.recorded[op] = result.recorded.get(op, 0.0) + record.duration
+        result.replayed[op] = result.replayed.get(op, 0.0) + elapsed
+        if op == DETECT:
+            if list(returned) != record.args[0]:
+                result.divergences.append(
+                    (index, record, 'victims %s' % list(returned)))
+        elif (returned is None) != bool(record.flags & BLOCKED):
+            if returned is None:
+                message = 'blocked'
+            else:
+                message = 'returned %r' % (returned,)
+            result.divergences.append((index, record, message))
+    forget_lock_manager(lockTable)
+    return result
+
+def dump(path):
+    for record in read_trace(path):
+        blocked = ''
+        if record.flags & BLOCKED:
+            blocked = ' blocked'
+        print('%12.6f %10.6f %-14s %6d %s%s' % (
+            record.start, record.duration, OP_NAMES[record.op], record.xid,
+            ' '.join(str(arg) for arg in record.args), blocked))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay or print a schedule trace.')
+    parser.add_argument('trace')
+    parser.add_argument('--dump', action='store_true',
+                        help='print the records instead of replaying them')
+    parser.add_argument('--prevention', default=None,
+                        choices=[student.NO_WAIT, student.WAIT_DIE,
+                                 student.WOUND_WAIT],
+                        help='replay under a deadlock prevention policy')
+    options = parser.parse_args(argv)
+    if options.dump:
+        dump(options.trace)
+        return
+    student.DEADLOCK_PREVENTION = options.prevention
+    result = replay(options.trace)
+    print('%d records, %d divergences' % (result.records,
+                                          len(result.divergences)))
+    print('op              recorded ms   replayed ms')
+    for op in sorted(result.replayed):
+        print('%-14s %12.3f %13.3f' % (OP_NAMES[op],
+                                       1000 * result.recorded[op],
+                                       1000 * result.replayed[op]))
+    for index, record, message in result.divergences[:20]:
+        print('record %d: %s by %d %s' % (index, OP_NAMES[record.op],
+                                          record.xid, message))
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
+import bisect
 import logging
+import threading
+import time
 
-
+from collections import deque
 
 from kvstore import DBMStore, InMemoryKVStore
 
@@ -14,19 +17,131 @@ Possible abort modes.
 USER = 0
 DEADLOCK = 1
 
+"""
+Lock modes. The intention modes are only taken on partitions, see
+LOCK_PARTITIONS. UPDATE is a read lock taken by a transaction that means to
+write the key later: it admits SHARED locks but no other UPDATE lock, so that
+two read-modify-write transactions queue up at the read instead of
+deadlocking when both convert to EXCLUSIVE. See perform_get_for_update().
+"""
+SHARED = 's'
+UPDATE = 'u'
+EXCLUSIVE = 'e'
+INTENTION_SHARED = 'is'
+INTENTION_EXCLUSIVE = 'ix'
+SHARED_INTENTION_EXCLUSIVE = 'six'
+
+"""
+Deadlock victim policies. Each one aborts the transaction of a deadlocked
+component whose abort wastes the least work by its own measure, breaking ties
+in favor of the youngest (highest xid) transaction.
+
+YOUNGEST: the transaction that started last.
+FEWEST_LOCKS: the transaction holding the fewest locks.
+SMALLEST_UNDO_LOG: the transaction with the fewest writes to undo or discard.
+FEWEST_RESTARTS: the transaction restarted the fewest times before, so that
+the same transaction is not starved by being picked over and over.
+"""
+YOUNGEST = 'youngest'
+FEWEST_LOCKS = 'fewest_locks'
+SMALLEST_UNDO_LOG = 'smallest_undo_log'
+FEWEST_RESTARTS = 'fewest_restarts'
+
+DEADLOCK_VICTIM_POLICY = YOUNGEST
+
+"""
+Deadlock prevention policies. With DEADLOCK_PREVENTION set, a lock request
+that cannot be granted is settled right away, using xids as timestamps (a
+lower xid is older), so that deadlocks cannot form and no waits-for graph is
+kept or searched:
+
+NO_WAIT: the requesting transaction aborts instead of waiting.
+WAIT_DIE: an older requester waits, a younger one aborts.
+WOUND_WAIT: an older requester aborts the younger transactions in its way and
+waits for the older ones; a younger requester waits.
+
+Aborted transactions are rolled back and release their locks at once, and
+TransactionCoordinator.detect_deadlocks() reports them so that the server
+aborts them as usual.
+"""
+NO_WAIT = 'no_wait'
+WAIT_DIE = 'wait_die'
+WOUND_WAIT = 'wound_wait'
+
+DEADLOCK_PREVENTION = None
+
+"""
+Lock table entries are removed as soon as nobody holds or waits for their key,
+and up to this many of them are kept for reuse.
+"""
+LOCK_ENTRY_POOL_SIZE = 1024
+
+"""
+Number of lock table stripes. With 0, the lock manager relies on the server
+being single-threaded and takes no mutexes. Otherwise the keys are hash-
+partitioned into this many stripes, each protected by its own mutex, so that
+TransactionHandler operations on keys of different stripes can run in
+parallel from a thread pool. The store must then tolerate concurrent calls on
+different keys.
+"""
+LOCK_STRIPES = 0
+
+"""
+Multi-granularity locking. With LOCK_PARTITIONS > 0, keys are hash-partitioned
+into this many partitions, and keys containing LOCK_PARTITION_SEPARATOR (if
+set) belong to the partition named by the prefix before it. Every key lock is
+then preceded by an INTENTION_SHARED or INTENTION_EXCLUSIVE lock on the key's
+partition. Once a transaction holds more than LOCK_ESCALATION_THRESHOLD key
+locks in one partition, they are traded for a single SHARED or EXCLUSIVE lock
+on the partition, provided it can be granted without waiting.
+"""
+LOCK_PARTITIONS = 0
+LOCK_PARTITION_SEPARATOR = None
+LOCK_ESCALATION_THRESHOLD = 1000
+
+"""
+Deferred updates. With DEFERRED_WRITES set, a transaction's PUTs are buffered
+in a private write set that its own GETs read first, and the store only sees
+them at commit, in one batch (the store's put_many, if it has one). Aborts
+then have nothing to undo.
+"""
+DEFERRED_WRITES = False
+
+"""
+Lock contention statistics. With LOCK_STATS set, the lock manager counts, for
+every key, the lock requests, conflicts, upgrades, the longest wait queue, the
+deadlock aborts and lock wait timeouts, and a histogram of the time the
+granted requests waited: bucket i counts the waits of at most
+LOCK_WAIT_BUCKETS[i] seconds, and a last bucket the longer ones. See
+TransactionCoordinator.lock_stats().
+"""
+LOCK_STATS = False
+LOCK_WAIT_BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0)
+
+"""
+Lock wait timeout, in seconds. A transaction that has waited longer than this
+for a lock is aborted by the coordinator's next deadlock check, which reports
+it like a deadlock victim. None waits forever. Can be set per transaction with
+TransactionHandler.set_lock_wait_timeout().
+"""
+LOCK_WAIT_TIMEOUT = None
+
 """
 Part I: Implementing request handling methods for the transaction handler
 
 The transaction handler has access to the following objects:
 
-self._lock_table: the global lock table. More information in the README.
+self._lock_table: the global lock table, mapping each key to its LockEntry.
+More information in the README.
 
-self._acquired_locks: a list of locks acquired by the transaction. Used to
-release locks when the transaction commits or aborts. This list is initially
-empty.
+self._acquired_locks: a dict mapping every key the transaction holds a lock
+on to the mode it holds. Used to release locks when the transaction commits
+or aborts. This dict is initially empty.
 
 self._desired_lock: the lock that the transaction is waiting to acquire as well
-as the operation to perform. This is initialized to None.
+as the operation to perform, as a (@key, @mode, @operation) tuple, where
+@operation is a (@method, @args) pair to call again once the lock is granted.
+This is initialized to None.
 
 self._xid: this transaction's ID. You may assume each transaction is assigned a
 unique transaction ID.
@@ -34,23 +149,930 @@ unique transaction ID.
 self._store: the in-memory key-value store. You may refer to kvstore.py for
 methods supported by the store.
 
-self._undo_log: a list of undo operations to be performed when the transaction
-is aborted. The undo operation is a tuple of the form (@key, @value). This list
-is initially empty.
+self._undo_log: the undo operations to be performed when the transaction is
+aborted, as a dict mapping every key the transaction wrote to its value before
+the first write (None if it did not exist). This dict is initially empty.
+
+self._undo_order: the keys of self._undo_log in the order they were first
+written, so that abort() undoes them in reverse order.
+
+self._write_set: with DEFERRED_WRITES, maps every key the transaction wrote to
+the value to store at commit. The undo log then stays empty.
+
+self._restarts: the number of times this transaction was aborted and resubmitted
+before. Whoever resubmits a transaction after a deadlock abort sets it on the
+new handler; it is only used to pick deadlock victims.
+
+self._snapshot: the timestamp of the snapshot a read-only transaction reads,
+see begin_snapshot(). None for locking transactions.
+
+self._doomed: whether the lock manager has aborted the transaction, to prevent
+a deadlock or because a lock wait timed out. Its operations then block until
+the server aborts it.
+
+self._wait_started: when the transaction last started waiting for a lock.
 
 You may assume that the key/value inputs to these methods are already type-
 checked and are valid.
 """
 
+"""
+Compatibility and conversion of lock modes. An empty granted group (None) is
+compatible with everything.
+"""
+_COMPATIBLE = {
+    INTENTION_SHARED: frozenset([None, INTENTION_SHARED, INTENTION_EXCLUSIVE,
+                                 SHARED, UPDATE, SHARED_INTENTION_EXCLUSIVE]),
+    INTENTION_EXCLUSIVE: frozenset([None, INTENTION_SHARED,
+                                    INTENTION_EXCLUSIVE]),
+    SHARED: frozenset([None, INTENTION_SHARED, SHARED, UPDATE]),
+    UPDATE: frozenset([None, INTENTION_SHARED, SHARED]),
+    SHARED_INTENTION_EXCLUSIVE: frozenset([None, INTENTION_SHARED]),
+    EXCLUSIVE: frozenset([None]),
+}
+
+_COVERS = {
+    INTENTION_SHARED: frozenset([INTENTION_SHARED]),
+    INTENTION_EXCLUSIVE: frozenset([INTENTION_SHARED, INTENTION_EXCLUSIVE]),
+    SHARED: frozenset([INTENTION_SHARED, SHARED]),
+    UPDATE: frozenset([INTENTION_SHARED, SHARED, UPDATE]),
+    SHARED_INTENTION_EXCLUSIVE: frozenset([INTENTION_SHARED,
+                                           INTENTION_EXCLUSIVE, SHARED,
+                                           UPDATE,
+                                           SHARED_INTENTION_EXCLUSIVE]),
+    EXCLUSIVE: frozenset(_COMPATIBLE),
+}
+
+#_SUPREMUM[a][b] is the weakest mode that covers both a and b
+_SUPREMUM = dict((a, {None: a}) for a in _COVERS)
+_SUPREMUM[None] = dict((a, a) for a in _COVERS)
+for a in _COVERS:
+    for b in _COVERS:
+        _SUPREMUM[a][b] = min((m for m in _COVERS
+                               if a in _COVERS[m] and b in _COVERS[m]),
+                              key=lambda m: len(_COVERS[m]))
+
+class LockEntry(object):
+    """
+    The lock table entry of a single key or partition.
+
+    granted: maps the xid of every transaction in the granted group to the
+    mode it holds.
+    counts: maps each mode held in the granted group to its number of
+    holders.
+    waiters: FIFO queue of (@mode, @handler) requests waiting for the lock.
+    upgrades: maps the xid of every granted holder that is waiting in the
+    queue to convert its lock to a stronger mode to its queued request.
+    mode: the mode of the granted group (the supremum of the modes held), or
+    None if the group is empty. Kept up to date so that compatibility checks
+    never look at the holders.
+    """
+    __slots__ = ('granted', 'counts', 'waiters', 'upgrades', 'mode')
+
+    def __init__(self):
+        self.granted = {}
+        self.counts = {}
+        self.waiters = deque()
+        self.upgrades = {}
+        self.mode = None
+
+    def others_mode(self, xid):
+        """
+        Returns the mode of the granted group without transaction @xid, or of
+        the whole group if @xid is None.
+        """
+        held = self.granted.get(xid)
+        mode = None
+        for m, n in self.counts.items():
+            if n > 1 or m != held:
+                mode = _SUPREMUM[mode][m]
+        return mode
+
+    def grantable(self, mode, xid):
+        """
+        Returns whether transaction @xid can hold @mode alongside the rest of
+        the granted group.
+        """
+        if xid in self.granted:
+            return self.others_mode(xid) in _COMPATIBLE[mode]
+        return self.mode in _COMPATIBLE[mode]
+
+    def grant(self, key, mode, handler):
+        """
+        Adds @handler to the granted group in @mode, or converts the lock it
+        already holds to @mode, and records the lock in the handler's acquired
+        locks.
+        """
+        counts = self.counts
+        held = self.granted.get(handler._xid)
+        if held is not None:
+            counts[held] -= 1
+            if not counts[held]:
+                del counts[held]
+        self.granted[handler._xid] = mode
+        counts[mode] = counts.get(mode, 0) + 1
+        self.mode = _SUPREMUM[self.mode][mode] if held is None else \
+            self.others_mode(None)
+        handler._acquired_locks[key] = mode
+
+    def release(self, xid):
+        """
+        Removes transaction @xid from the granted group.
+        """
+        counts = self.counts
+        held = self.granted.pop(xid)
+        counts[held] -= 1
+        if not counts[held]:
+            del counts[held]
+        self.mode = self.others_mode(None)
+
+    def grant_waiters(self, key, waits_for, woken):
+        """
+        Grants the lock to the set of mutually compatible requests at the head
+        of the queue, appends their handlers to @woken, and moves the waits-for
+        edges of the requests left in the queue onto the new holders. A holder
+        waiting to convert its lock is granted as soon as the conversion is
+        compatible with the other holders, wherever it sits in the queue,
+        since every request ahead of it is waiting on it anyway.
+        """
+        waiters = self.waiters
+        newHolders = []
+        if self.upgrades:
+            for xid, request in list(self.upgrades.items()):
+                mode, handler = request
+                if self.grantable(mode, xid):
+                    del self.upgrades[xid]
+                    waiters.remove(request)
+                    waits_for.stop_waiting(xid)
+                    self.grant(key, mode, handler)
+                    woken.append(handler)
+        while waiters:
+            mode, handler = waiters[0]
+            if not self.grantable(mode, handler._xid):
+                break
+            waiters.popleft()
+            self.upgrades.pop(handler._xid, None)
+            waits_for.stop_waiting(handler._xid)
+            self.grant(key, mode, handler)
+            woken.append(handler)
+            newHolders.append(handler._xid)
+        if newHolders and waiters:
+            waits_for.add_holders(waiters, newHolders)
+
+class KeyStats(object):
+    """
+    The contention statistics of one key, see LOCK_STATS.
+
+    acquires: the lock requests on the key, other than for a lock already
+    held.
+    conflicts: the requests that could not be granted right away.
+    upgrades: the requests to convert a lock already held.
+    max_queue: the longest the wait queue of the key has been.
+    wait_times: the histogram of the time granted requests waited.
+    deadlock_aborts: the transactions aborted to break or prevent a deadlock
+    while waiting for the key.
+    timeouts: the transactions aborted after waiting too long for the key.
+    """
+    __slots__ = ('acquires', 'conflicts', 'upgrades', 'max_queue',
+                 'wait_times', 'deadlock_aborts', 'timeouts')
+
+    def __init__(self):
+        self.acquires = 0
+        self.conflicts = 0
+        self.upgrades = 0
+        self.max_queue = 0
+        self.wait_times = [0] * (len(LOCK_WAIT_BUCKETS) + 1)
+        self.deadlock_aborts = 0
+        self.timeouts = 0
+
+    def copy(self):
+        stats = KeyStats()
+        for name in KeyStats.__slots__:
+            setattr(stats, name, getattr(self, name))
+        stats.wait_times = list(self.wait_times)
+        return stats
+
+class WaitsForGraph(object):
+    """
+    The waits-for edges of the transactions queued on the keys of one lock
+    table stripe, kept up to date by the transaction handlers as requests are
+    queued, granted and released, so that the coordinator never has to
+    rebuild them from the lock table. A transaction waits for one key at a
+    time, so its edges are all in the stripe of that key.
+
+    edges: maps the xid of every waiting transaction to the set of xids it
+    waits for (the holders of the key it is queued on, other than itself).
+    handlers: maps the xid of every waiting transaction to its handler. Shared
+    by the graphs of all stripes.
+    dirty: xids whose set of out-edges has grown since the last check. Only
+    edges that were added can close a new cycle, so a check only needs to
+    start from these.
+    changed: whether any edge was added or removed since the last check.
+    """
+    __slots__ = ('edges', 'handlers', 'dirty', 'changed')
+
+    def __init__(self, handlers):
+        self.edges = {}
+        self.handlers = handlers
+        self.dirty = set()
+        self.changed = False
+
+    def wait(self, handler, holders):
+        xid = handler._xid
+        edges = set(holders)
+        edges.discard(xid)
+        self.edges[xid] = edges
+        self.handlers[xid] = handler
+        self.dirty.add(xid)
+        self.changed = True
+
+    def stop_waiting(self, xid):
+        if self.edges.pop(xid, None) is not None:
+            del self.handlers[xid]
+            self.changed = True
+
+    def add_holders(self, waiters, holders):
+        """
+        Adds edges from each of @waiters (a lock queue) to each of @holders.
+        """
+        for mode, handler in waiters:
+            edges = self.edges[handler._xid]
+            for xid in holders:
+                if xid != handler._xid:
+                    edges.add(xid)
+            self.dirty.add(handler._xid)
+        self.changed = True
+
+    def remove_holder(self, waiters, xid):
+        """
+        Removes the edges from each of @waiters (a lock queue) to @xid.
+        """
+        for mode, handler in waiters:
+            self.edges[handler._xid].discard(xid)
+        self.changed = True
+
+class _NoWaitsFor(object):
+    """
+    Stands in for the waits-for graph of a stripe when a deadlock prevention
+    policy makes it unnecessary.
+    """
+    __slots__ = ()
+
+    def wait(self, handler, holders):
+        pass
+
+    def stop_waiting(self, xid):
+        pass
+
+    def add_holders(self, waiters, holders):
+        pass
+
+    def remove_holder(self, waiters, xid):
+        pass
+
+_NO_WAITS_FOR = _NoWaitsFor()
+
+class _NoLock(object):
+    """
+    Stands in for a mutex when the lock manager runs single-threaded.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def acquire(self):
+        return True
+
+    def release(self):
+        pass
+
+_NO_LOCK = _NoLock()
+
+class LockStripe(object):
+    """
+    The part of the lock manager state that belongs to the keys of one
+    stripe. Everything in it, and the lock table entries of its keys, may only
+    be touched while holding its mutex.
+
+    live_entries: the number of entries of the stripe in the lock table.
+    entry_pool: idle entries kept for reuse.
+    stats: maps the keys of the stripe to their KeyStats, or None if
+    LOCK_STATS is off.
+    """
+    __slots__ = ('lock_table', 'mutex', 'waits_for', 'live_entries',
+                 'entry_pool', 'stats')
+
+    def __init__(self, lock_table, mutex, waits_for, stats=None):
+        self.lock_table = lock_table
+        self.mutex = mutex
+        self.waits_for = waits_for
+        self.live_entries = 0
+        self.entry_pool = []
+        self.stats = stats
+
+    def new_entry(self, key):
+        if self.entry_pool:
+            entry = self.entry_pool.pop()
+        else:
+            entry = LockEntry()
+        self.lock_table[key] = entry
+        self.live_entries += 1
+        return entry
+
+    def reclaim_entry(self, key, entry):
+        """
+        Removes the entry of @key from the lock table if it has become idle.
+        """
+        if entry.granted or entry.waiters:
+            return
+        del self.lock_table[key]
+        self.live_entries -= 1
+        if len(self.entry_pool) < LOCK_ENTRY_POOL_SIZE:
+            self.entry_pool.append(entry)
+
+    def key_stats(self, key):
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = KeyStats()
+        return stats
+
+    def note_waits(self, key, handlers):
+        """
+        Adds the waits of @handlers, just granted the lock on @key, to its
+        wait time histogram.
+        """
+        now = time.time()
+        waitTimes = self.key_stats(key).wait_times
+        for handler in handlers:
+            waited = now - handler._wait_started
+            waitTimes[bisect.bisect_left(LOCK_WAIT_BUCKETS, waited)] += 1
+
+class LockManager(object):
+    """
+    State shared by every transaction handler and the coordinator of one
+    lock table, beyond the lock table entries themselves.
+
+    stripes: the lock table stripes; keys are assigned to them by hash.
+    waiting: maps the xid of every waiting transaction to its handler.
+    threaded: whether the stripes are protected by real mutexes.
+    ready: if not None, a queue of the handlers whose blocked operation has
+    completed since the server loop last drained it.
+    partitions, separator, escalation_threshold: the multi-granularity
+    locking settings, see LOCK_PARTITIONS.
+    prevention: the deadlock prevention policy, see DEADLOCK_PREVENTION.
+    transactions: maps the xid of every running transaction to its handler.
+    doomed: the xids of the transactions aborted by the lock manager that the
+    server has not aborted yet, protected by doomed_latch.
+    wait_timeouts: whether any transaction may have a lock wait timeout.
+    """
+
+    def __init__(self, lock_table, stripes=None):
+        if stripes is None:
+            stripes = LOCK_STRIPES
+        self.lock_table = lock_table
+        self.partitions = LOCK_PARTITIONS
+        self.separator = LOCK_PARTITION_SEPARATOR
+        self.escalation_threshold = LOCK_ESCALATION_THRESHOLD
+        self.prevention = DEADLOCK_PREVENTION
+        self.threaded = stripes > 0
+        self.waiting = {}
+        self.stripes = [LockStripe(lock_table, self.new_latch(),
+                                   self.new_waits_for(),
+                                   {} if LOCK_STATS else None)
+                        for i in range(max(stripes, 1))]
+        self.stripes[0].live_entries = len(lock_table)
+        self.ready = None
+        self.transactions = {}
+        self.doomed = set()
+        self.doomed_latch = self.new_latch()
+        self.wait_timeouts = LOCK_WAIT_TIMEOUT is not None
+
+    def new_latch(self, reentrant=False):
+        """
+        Returns a mutex, or a stand-in if the lock manager is single-threaded.
+        """
+        if not self.threaded:
+            return _NO_LOCK
+        if reentrant:
+            return threading.RLock()
+        return threading.Lock()
+
+    def new_waits_for(self):
+        if self.prevention is not None:
+            return _NO_WAITS_FOR
+        return WaitsForGraph(self.waiting)
+
+    def stripe_index(self, key):
+        if len(self.stripes) == 1:
+            return 0
+        return hash(key) % len(self.stripes)
+
+    def stripe_of(self, key):
+        return self.stripes[self.stripe_index(key)]
+
+    def live_entries(self):
+        return sum(stripe.live_entries for stripe in self.stripes)
+
+    def partition_of(self, key):
+        """
+        Returns the lock table key of the partition that @key belongs to, or
+        None if multi-granularity locking is off.
+        """
+        separator = self.separator
+        if separator is not None and separator in key:
+            return ('partition', key.split(separator, 1)[0])
+        if self.partitions:
+            return ('partition', hash(key) % self.partitions)
+        return None
+
+    def note_abort(self, key, timeout=False):
+        """
+        Counts the abort of a transaction that was waiting for @key, as a
+        deadlock abort or a lock wait timeout.
+        """
+        stripe = self.stripe_of(key)
+        if stripe.stats is None:
+            return
+        with stripe.mutex:
+            stats = stripe.key_stats(key)
+            if timeout:
+                stats.timeouts += 1
+            else:
+                stats.deadlock_aborts += 1
+
+    def forget_doomed(self, xids):
+        """
+        Called once the server has aborted the doomed transactions @xids.
+        """
+        with self.doomed_latch:
+            self.doomed.difference_update(xids)
+
+    def edges_of(self, xid):
+        """
+        Reads the xids that transaction @xid waits for under the mutex of the
+        stripe of the key it is queued on.
+
+        @return: an (@edges, @handler, @key) tuple, or None if the transaction
+        is not waiting.
+        """
+        handler = self.waiting.get(xid)
+        desired = handler and handler._desired_lock
+        if desired is None:
+            return None
+        key = desired[0]
+        stripe = self.stripe_of(key)
+        with stripe.mutex:
+            edges = stripe.waits_for.edges.get(xid)
+            if edges is None:
+                return None
+            return list(edges), handler, key
+
+"""
+The server hands the same plain dict to every TransactionHandler and to the
+TransactionCoordinator, so the LockManager of a lock table is looked up by the
+table's identity. The manager keeps the table alive, so ids are never reused
+until forget_lock_manager() drops it.
+"""
+_lock_managers = {}
+#Serializes the creation of managers, so that the threads creating the first
+#handlers of a table concurrently all get the same one
+_lock_managers_mutex = threading.Lock()
+
+def get_lock_manager(lock_table):
+    manager = _lock_managers.get(id(lock_table))
+    if manager is None:
+        with _lock_managers_mutex:
+            manager = _lock_managers.get(id(lock_table))
+            if manager is None:
+                manager = LockManager(lock_table)
+                _lock_managers[id(lock_table)] = manager
+    return manager
+
+def forget_lock_manager(lock_table):
+    """
+    Drops the LockManager of @lock_table, and with it the table, once no
+    handler or coordinator of the table will be used anymore.
+    """
+    with _lock_managers_mutex:
+        _lock_managers.pop(id(lock_table), None)
+
+class VersionedStore(object):
+    """
+    Wraps a key-value store to also keep the committed versions of recently
+    written keys, so that read-only transactions can read a consistent
+    snapshot without taking any locks. To use it, set KVSTORE_CLASS to
+    VersionedStore (which wraps an InMemoryKVStore), or to a function that
+    returns a VersionedStore wrapping another store.
+
+    Locking transactions read and write the wrapped store in place as usual,
+    but tell the VersionedStore which keys they write and when they commit.
+    Each commit that wrote anything gets the next timestamp, and a snapshot
+    sees every commit up to the timestamp it was opened at.
+
+    A key only has a version history while someone may need one: from the
+    first uncommitted write to it, until no open snapshot is older than its
+    latest committed version. A key without a history has not been written
+    since before any open snapshot, so the wrapped store has the right value.
+    """
+
+    def __init__(self, store=None):
+        if store is None:
+            store = InMemoryKVStore()
+        self._store = store
+        self._mutex = threading.Lock()
+        self._timestamp = 0
+        #key -> ([commit timestamps], [values]), oldest first
+        self._versions = {}
+        #timestamp -> number of open snapshots at that timestamp
+        self._snapshots = {}
+        #keys written by a transaction that has not finished yet
+        self._uncommitted = set()
+
+    def __getattr__(self, name):
+        return getattr(self._store, name)
+
+    def get(self, key):
+        return self._store.get(key)
+
+    def put(self, key, value):
+        self._store.put(key, value)
+
+    def begin_write(self, key):
+        """
+        Called before a transaction writes @key in place, so that snapshots
+        keep reading its last committed value.
+        """
+        with self._mutex:
+            if key not in self._versions:
+                #Older than every open snapshot, see the class docstring
+                self._versions[key] = ([0], [self._store.get(key)])
+            self._uncommitted.add(key)
+
+    def commit_writes(self, keys):
+        """
+        Called when a transaction that wrote @keys commits, while it still
+        holds their locks.
+        """
+        with self._mutex:
+            self._timestamp += 1
+            for key in keys:
+                timestamps, values = self._versions[key]
+                timestamps.append(self._timestamp)
+                values.append(self._store.get(key))
+                self._uncommitted.discard(key)
+            self._collect(keys)
+
+    def abort_writes(self, keys):
+        """
+        Called when a transaction that wrote @keys aborts, once it has undone
+        its writes.
+        """
+        with self._mutex:
+            self._uncommitted.difference_update(keys)
+            self._collect(keys)
+
+    def open_snapshot(self):
+        """
+        Returns the timestamp of a new snapshot of the committed state.
+        """
+        with self._mutex:
+            ts = self._timestamp
+            self._snapshots[ts] = self._snapshots.get(ts, 0) + 1
+            return ts
+
+    def close_snapshot(self, ts):
+        with self._mutex:
+            self._snapshots[ts] -= 1
+            if not self._snapshots[ts]:
+                del self._snapshots[ts]
+            self._collect(list(self._versions))
+
+    def get_version(self, key, ts):
+        """
+        Returns the value of @key in the snapshot at timestamp @ts.
+        """
+        with self._mutex:
+            history = self._versions.get(key)
+            if history is None:
+                return self._store.get(key)
+            timestamps, values = history
+            return values[bisect.bisect_right(timestamps, ts) - 1]
+
+    def _collect(self, keys):
+        """
+        Drops the versions of @keys that no open snapshot can read anymore.
+        Must be called with self._mutex held.
+        """
+        if self._snapshots:
+            oldest = min(self._snapshots)
+        else:
+            oldest = self._timestamp
+        for key in keys:
+            timestamps, values = self._versions[key]
+            #The newest version at or before the oldest snapshot is the
+            #oldest one still needed
+            i = bisect.bisect_right(timestamps, oldest) - 1
+            if i > 0:
+                del timestamps[:i]
+                del values[:i]
+            if len(timestamps) == 1 and key not in self._uncommitted:
+                del self._versions[key]
+
 class TransactionHandler:
 
     def __init__(self, lock_table, xid, store):
         self._lock_table = lock_table
-        self._acquired_locks = []
+        self._manager = get_lock_manager(lock_table)
+        #Reentrant, as the prevention policy may abort the transaction from
+        #within one of its own blocked operations
+        self._latch = self._manager.new_latch(reentrant=True)
+        self._acquired_locks = {}
         self._desired_lock = None
         self._xid = xid
         self._store = store
-        self._undo_log = []
+        self._undo_log = {}
+        self._undo_order = []
+        self._deferred = DEFERRED_WRITES
+        self._write_set = {}
+        self._restarts = 0
+        self._result = None
+        self._grant_callback = None
+        self._fine_locks = {}
+        self._fine_writes = {}
+        self._snapshot = None
+        self._versioned = isinstance(store, VersionedStore)
+        self._doomed = False
+        self._abort_callback = None
+        self._wait_started = None
+        self._lock_wait_timeout = LOCK_WAIT_TIMEOUT
+        self._manager.transactions[xid] = self
+
+    def begin_snapshot(self):
+        """
+        Turns the transaction into a read-only transaction that reads a
+        consistent snapshot of the committed state, without taking any locks.
+        Only possible with a VersionedStore, and before the transaction has
+        taken any lock.
+
+        @param self: the transaction handler.
+
+        @return: 'Success', or a message saying why the transaction cannot
+        read a snapshot.
+        """
+        if not self._versioned:
+            return 'Snapshots not supported'
+        if self._acquired_locks or self._desired_lock is not None:
+            return 'Transaction already started'
+        if self._snapshot is None:
+            self._snapshot = self._store.open_snapshot()
+        return 'Success'
+
+    def set_grant_callback(self, callback):
+        """
+        Registers @callback to be called as callback(@handler, @result) when a
+        blocked operation of this transaction completes, with the result
+        check_lock() would have returned. Passing None unregisters it.
+        """
+        self._grant_callback = callback
+
+    def set_abort_callback(self, callback):
+        """
+        Registers @callback to be called as callback(@handler) when the lock
+        manager aborts this transaction on its own, e.g. to prevent a
+        deadlock. The server still has to call abort(DEADLOCK). Passing None
+        unregisters it.
+        """
+        self._abort_callback = callback
+
+    def set_lock_wait_timeout(self, timeout):
+        """
+        Sets the number of seconds the transaction may wait for a lock before
+        it is aborted, overriding LOCK_WAIT_TIMEOUT. None waits forever.
+        """
+        self._lock_wait_timeout = timeout
+        if timeout is not None:
+            self._manager.wait_timeouts = True
+
+    def _lock_granted(self):
+        """
+        Called once the lock in self._desired_lock has been granted: performs
+        the blocked operation right away and hands its result to the grant
+        callback, or keeps it for check_lock().
+        """
+        with self._latch:
+            #The transaction may have been aborted since it was granted
+            if self._desired_lock is None:
+                return
+            method, args = self._desired_lock[2]
+            self._desired_lock = None
+            result = method(*args)
+        if result is None:
+            return
+        if self._grant_callback is not None:
+            self._grant_callback(self, result)
+            return
+        self._result = result
+        if self._manager.ready is not None:
+            self._manager.ready.append(self)
+
+    def _lock(self, key, mode, operation):
+        """
+        Acquires the locks needed to access @key in @mode: the key lock and,
+        with multi-granularity locking, the intention lock on its partition
+        first, unless a partition lock already covers the access.
+
+        @return: True if the transaction holds the locks, False if it has to
+        wait for one of them, see _acquire().
+        """
+        if self._doomed:
+            return False
+        partition = self._manager.partition_of(key)
+        if partition is None:
+            return self._acquire(key, mode, operation)
+        held = self._acquired_locks.get(partition)
+        if held is not None and mode in _COVERS[held]:
+            return True
+        if mode == EXCLUSIVE:
+            intention = INTENTION_EXCLUSIVE
+        else:
+            intention = INTENTION_SHARED
+        if not self._acquire(partition, intention, operation):
+            return False
+        if not self._acquire(key, mode, operation):
+            return False
+        self._note_fine_lock(partition, key, mode)
+        return True
+
+    def _acquire(self, key, mode, operation, wait=True):
+        """
+        Acquires the lock on @key in @mode, creating the lock table entry if
+        needed. If the lock cannot be granted right away and @wait is set, the
+        request is queued and saved in self._desired_lock together with the
+        @operation to resume.
+
+        With a deadlock prevention policy, a request that cannot be granted
+        may abort this transaction instead of waiting, or abort the ones in
+        its way and try again.
+
+        @return: True if the transaction holds the lock, False if it has to
+        wait for it or was aborted.
+        """
+        xid = self._xid
+        manager = self._manager
+        stripe = manager.stripe_of(key)
+        while True:
+            with stripe.mutex:
+                entry = self._lock_table.get(key)
+                if entry is None:
+                    entry = stripe.new_entry(key)
+                held = entry.granted.get(xid)
+                mode = _SUPREMUM[held][mode]
+                if held == mode:
+                    return True
+                stats = stripe.stats
+                if stats is not None:
+                    stats = stripe.key_stats(key)
+                    stats.acquires += 1
+                    if held is not None:
+                        stats.upgrades += 1
+                #Compatible with the granted group, and nobody is queued ahead.
+                #A conversion goes first, as everyone queued waits for it.
+                if ((held is not None or not entry.waiters)
+                        and entry.grantable(mode, xid)):
+                    entry.grant(key, mode, self)
+                    return True
+                if stats is not None:
+                    stats.conflicts += 1
+                if not wait:
+                    stripe.reclaim_entry(key, entry)
+                    return False
+                victims = None
+                if manager.prevention is not None:
+                    victims = self._prevention_victims(entry)
+                if not victims:
+                    request = (mode, self)
+                    self._wait_started = time.time()
+                    self._desired_lock = (key, mode, operation)
+                    if held is None:
+                        entry.waiters.append(request)
+                    else:
+                        #Conversions queue ahead of everyone but earlier
+                        #conversions, as the requests behind them wait for
+                        #the converting holders anyway
+                        converting = len(entry.upgrades)
+                        entry.upgrades[xid] = request
+                        entry.waiters.rotate(-converting)
+                        entry.waiters.appendleft(request)
+                        entry.waiters.rotate(converting)
+                    stripe.waits_for.wait(self, entry.granted)
+                    if stats is not None:
+                        stats.max_queue = max(stats.max_queue,
+                                              len(entry.waiters))
+                    return False
+                if stats is not None:
+                    stats.deadlock_aborts += len(victims)
+                stripe.reclaim_entry(key, entry)
+            #Aborts take the stripe mutexes themselves
+            if self in victims:
+                self._doom()
+                return False
+            for handler in victims:
+                handler._doom()
+
+    def _prevention_victims(self, entry):
+        """
+        Settles a conflict on @entry under the deadlock prevention policy.
+        Everyone the request would wait for holds the key or is queued on it
+        already (a conversion only waits for the conversions queued ahead of
+        it), so waiting only for younger (wait-die) or only for older
+        (wound-wait) transactions keeps the waits-for graph acyclic. Must be
+        called with the mutex of the entry's stripe held.
+
+        @return: the handlers of the transactions to abort, possibly this
+        one, or an empty list if the request may wait.
+        """
+        policy = self._manager.prevention
+        if policy == NO_WAIT:
+            return [self]
+        xid = self._xid
+        transactions = self._manager.transactions
+        blockers = dict((g, transactions.get(g)) for g in entry.granted
+                        if g != xid)
+        converting = xid in entry.granted
+        for mode, handler in entry.waiters:
+            if converting and handler._xid not in entry.upgrades:
+                break
+            blockers[handler._xid] = handler
+        if policy == WAIT_DIE:
+            if min(blockers) < xid:
+                return [self]
+            return []
+        return [handler for g, handler in blockers.items()
+                if g > xid and handler is not None]
+
+    def _doom(self):
+        """
+        Aborts the transaction on behalf of the lock manager: rolls it back
+        and releases its locks right away, and leaves its xid for the
+        coordinator to report, so that the server aborts it as usual. Does
+        nothing if the transaction has already finished.
+
+        @return: whether the transaction was aborted.
+        """
+        manager = self._manager
+        with self._latch:
+            if self._doomed or manager.transactions.get(self._xid) is not self:
+                return False
+            self._doomed = True
+            with manager.doomed_latch:
+                manager.doomed.add(self._xid)
+            woken = self._rollback()
+        self._wake(woken)
+        if self._abort_callback is not None:
+            self._abort_callback(self)
+        return True
+
+    def _note_fine_lock(self, partition, key, mode):
+        """
+        Records a key lock held in @partition, and escalates to a lock on the
+        whole partition once there are too many of them.
+        """
+        keys = self._fine_locks.get(partition)
+        if keys is None:
+            keys = self._fine_locks[partition] = set()
+        if key not in keys:
+            keys.add(key)
+        elif mode != EXCLUSIVE:
+            return
+        if mode == EXCLUSIVE:
+            self._fine_writes[partition] = \
+                self._fine_writes.get(partition, 0) + 1
+        threshold = self._manager.escalation_threshold
+        if threshold and len(keys) > threshold:
+            self._escalate(partition)
+
+    def _escalate(self, partition):
+        """
+        Trades the key locks held in @partition for a SHARED or EXCLUSIVE
+        lock on the partition, if that can be granted without waiting.
+        """
+        if self._fine_writes.get(partition):
+            mode = EXCLUSIVE
+        else:
+            mode = SHARED
+        if not self._acquire(partition, mode, None, wait=False):
+            return
+        #The partition lock excludes everyone else who could want the keys
+        woken = []
+        for key in self._fine_locks.pop(partition):
+            self._release(key, woken)
+            del self._acquired_locks[key]
+        self._fine_writes.pop(partition, None)
+        self._wake(woken)
 
     def perform_put(self, key, value):
         """
@@ -72,99 +1094,17 @@ class TransactionHandler:
         @return: if the transaction successfully acquires the lock and performs
         the insertion/update, returns 'Success'. If the transaction cannot
         acquire the lock, returns None, and saves the lock that the transaction
-        is waiting to acquire in self._desired_lock.
-        """
-        # Part 1.1: your code here!
+        is waiting to acquire in self._desired_lock. A read-only transaction
+        returns 'Read-only Transaction'.
         """
-        As discussed in class, the lock table needs to keep track, for each key in 
-        the table, of two basic things:
-
-        Which transactions currently have a lock on that key (the "granted group" of transactions), 
-        and what the lock mode is.
-        A queue of transactions that are waiting to be granted a lock on that key -- 
-        and the lock mode that they are waiting for.
-
-        """
-
-
-
-        #if the lock table does not contain the key entry yet, you should create one.
-        if key not in self._lock_table.keys():
-            #Lock Table contains current lock mode and granted group
-            #Lock Table contains waiting a queue of transactions and lock mode
-            self._lock_table[key] = [ [['e', self]] , [] ]
-            self._acquired_locks.append( [key, ['e', self]] )
-
-            preV = self._store.get(key)
-            self._store.put(key, value)
-            self._undo_log.append((key, preV))   
+        if self._snapshot is not None:
+            return 'Read-only Transaction'
+        with self._latch:
+            if not self._lock(key, EXCLUSIVE,
+                              (self.perform_put, (key, value))):
+                return None
+            self._write(key, value)
             return 'Success'
-        else:
-            grantedGroup = self._lock_table[key][0]
-            waitingGroup = self._lock_table[key][1]
-            #If grantedGroup is empty
-            if len(grantedGroup)== 0:
-                self._lock_table[key][0].append(['e', self])
-                self._acquired_locks.append( [key, ['e', self]])
-                #For log
-                v = self._store.get(key)
-                self._undo_log.append( [key,v] )
-                self._store.put(key, value)
-                return 'Success'
-            #If we have grantedGroup
-            else:
-                mode = self._lock_table[key][0][0][0]
-                #if it is a shared Group
-                if mode == 's':
-                    #if current transaction is in grantedGroup
-                    #And, there is no other transcation waiting for this lock
-                    if ['s', self] in grantedGroup and len(waitingGroup)==0:
-                        #check if it is the only transaction holding shared lock
-                        #If it is, we can upgrade to exclusive lock, then, PUT
-                        if len(grantedGroup)==1:
-                            #update mode to exclusive
-                            self._lock_table[key][0][0][0] = 'e'
-                            #update acquired_locks
-                            acIndex = self._acquired_locks.index([key, ['s', self]])
-                            self._acquired_locks[acIndex][1][0] = 'e'
-                            #For log
-                            preV = preV = self._store.get(key)
-                            self._undo_log.append((key, preV))
-                            self._store.put(key, value)
-                            return 'Success'
-                        #If there are other transactions sharing this lock
-                        #we put this transaction in waitingGroup and desired_lock
-                        #since other transactions are using it
-                        elif len(grantedGroup)>1:
-                            self._lock_table[key][1].append(['e',self])
-                            self._desired_lock = [key, ['e',self], value]
-                            
-                            return None
-                    #If this transaction is not in the grantedGroup, 
-                    #And, the lock is shared by other transaction/transactions
-                    #we put transaction in waitingGroup, and desired_locks
-                    else: 
-                        self._lock_table[key][1].append(['e',self])
-                        self._desired_lock = [key, ['e',self], value]
-                        
-                        return None
-                elif mode == 'e':
-                    #if this transaction is currently holding exclusive lock,
-                    #Success
-                    if ['e', self] in grantedGroup:
-                        #For log
-                        preV = self._store.get(key)
-                        self._undo_log.append((key, preV))
-                        self._store.put(key, value)
-                        return 'Success'
-                    #If this exclusive lock is held by other transaction, 
-                    #We put this in our waitingGroup, and desired_lock
-                    else:
-                        self._lock_table[key][1].append(['e',self])
-                        self._desired_lock = [key, ['e',self], value]
-                        return None
-
-        
 
     def perform_get(self, key):
         """
@@ -182,85 +1122,133 @@ class TransactionHandler:
         the value, returns the value. If the key does not exist, returns 'No
         such key'. If the transaction cannot acquire the lock, returns None,
         and saves the lock that the transaction is waiting to acquire in
-        self._desired_lock.
-        """
-        # Part 1.1: your code here!
-        #if there is no lock_table, we create one
-        if key not in self._lock_table.keys():
-            #Lock Table contains current lock mode and granted group
-            #Lock Table contains waiting a queue of transactions and lock mode
-            self._lock_table[key] = [ [['s', self]] , [] ]
-            self._acquired_locks.append([key, ['s', self]])
-            value = self._store.get(key)
-            if value is None:
-                return 'No such key'
-            else:
-                return value
-        #if there is key
-        else:
-            grantedGroup = self._lock_table[key][0]
-            waitingGroup = self._lock_table[key][1]
-            #If there is no grantedGroup and no waitingGroup
-            if len(grantedGroup) == 0 and len(waitingGroup) == 0:
-                #set lock for this transaction
-                self._lock_table[key][0].append( ['s', self] )
-                self._acquired_locks.append( [key, ['s', self]] )
-                value = self._store.get(key)
-                if value is None:
-                    return 'No such key'
-                return value
-            #If there is grantedGroup
-            else:
-                mode = self._lock_table[key][0][0][0]
-                #if the grantedGroup is for sharing    
-                if mode == 's':
-                    #If this transaction is already in grantedGroup
-                    if ['s', self] in grantedGroup:
-                        value = self._store.get(key)
-                        if value is None:
-                            return 'No such key'
-                        return value
-                    #If this is not in grantedGroup,
-                    else:
-                        #If there is no waiting group,
-                        #It is compatible
-                        if len(waitingGroup) == 0:
-                            self._lock_table[key][0].append( ['s', self] )
-                            self._acquired_locks.append( [key, ['s', self]] )
-                            value = self._store.get(key)
-                            if value is None:
-                                return 'No such key'
-                            return value
-                        #If there is a waiting group,
-                        #It is not compatible
-                        else:
-                            self._lock_table[key][1].append( ['s',self] )
-                            self._desired_lock = [key, ['s', self], 0]
-                            return None
-                elif mode == 'e':
-                    #If this transection has exclusive lock on this key,
-                    if ['e', self] in grantedGroup:
-                        value = self._store.get(key)
-                        if value is None:
-                            return 'No such key'
-                        return value
-                    #if other transaction is holding a e-lock on this key
-                    #we put it in queue, _desired_locks
-                    else:
-                        self._lock_table[key][1].append( ['s',self] )
-                        self._desired_lock = [key, ['s', self], 0]
-                        return None
+        self._desired_lock. A read-only transaction reads its snapshot
+        instead, and never waits.
+        """
+        if self._snapshot is not None:
+            return self._read_snapshot(key)
+        with self._latch:
+            if not self._lock(key, SHARED, (self.perform_get, (key,))):
+                return None
+            return self._read(key)
+
+    def perform_get_for_update(self, key):
+        """
+        Handles a GET request for a key the transaction means to PUT later.
+        Takes an UPDATE lock instead of a shared one, so that the PUT's
+        conversion to an exclusive lock only waits for plain readers.
 
-        
+        @param self: the transaction handler.
+        @param key: the key to look up from the store.
+
+        @return: the same as perform_get(). A read-only transaction returns
+        'Read-only Transaction'.
+        """
+        if self._snapshot is not None:
+            return 'Read-only Transaction'
+        with self._latch:
+            if not self._lock(key, UPDATE,
+                              (self.perform_get_for_update, (key,))):
+                return None
+            return self._read(key)
+
+    def perform_multi_get(self, keys):
+        """
+        Handles a GET request for several keys at once. The shared locks are
+        acquired in sorted key order, so that batches cannot deadlock each
+        other, and the values are read once all of them are held.
 
+        @param self: the transaction handler.
+        @param keys: the list of keys to look up from the store.
 
+        @return: if the transaction acquires all the locks, returns the list
+        of values of @keys, in the same order, with 'No such key' for keys
+        that do not exist. Otherwise, returns None and saves the lock it is
+        waiting for in self._desired_lock; the batch resumes from that key
+        once the lock is granted, and check_lock() returns the list.
+        """
+        if self._snapshot is not None:
+            return [self._read_snapshot(key) for key in keys]
+        with self._latch:
+            return self._multi_get(keys, sorted(set(keys)), 0)
+
+    def _multi_get(self, keys, ordered, start):
+        for i in range(start, len(ordered)):
+            if not self._lock(ordered[i], SHARED,
+                              (self._multi_get, (keys, ordered, i))):
+                return None
+        return [self._read(key) for key in keys]
+
+    def perform_multi_put(self, items):
+        """
+        Handles a PUT request for several key-value pairs at once. The
+        exclusive locks are acquired in sorted key order, and the pairs are
+        inserted once all of them are held.
+
+        @param self: the transaction handler.
+        @param items: the list of (@key, @value) pairs to insert, in order.
 
+        @return: if the transaction acquires all the locks and performs the
+        insertions, returns 'Success'. Otherwise, returns None and saves the
+        lock it is waiting for in self._desired_lock; the batch resumes from
+        that key once the lock is granted. A read-only transaction returns
+        'Read-only Transaction'.
+        """
+        if self._snapshot is not None:
+            return 'Read-only Transaction'
+        with self._latch:
+            return self._multi_put(items,
+                                   sorted(set(key for key, value in items)), 0)
+
+    def _multi_put(self, items, ordered, start):
+        for i in range(start, len(ordered)):
+            if not self._lock(ordered[i], EXCLUSIVE,
+                              (self._multi_put, (items, ordered, i))):
+                return None
+        for key, value in items:
+            self._write(key, value)
+        return 'Success'
+
+    def _read(self, key):
+        """
+        Reads @key from the store, once the transaction holds a lock on it.
+        """
+        if key in self._write_set:
+            value = self._write_set[key]
+        else:
+            value = self._store.get(key)
+        if value is None:
+            return 'No such key'
+        return value
+
+    def _read_snapshot(self, key):
+        value = self._store.get_version(key, self._snapshot)
+        if value is None:
+            return 'No such key'
+        return value
+
+    def _write(self, key, value):
+        """
+        Writes @key to the store, once the transaction holds an exclusive lock
+        on it. The value before the transaction's first write to @key is
+        logged for abort(); later writes need no undo of their own. With
+        deferred updates, the write only goes to the write set.
+        """
+        if self._deferred:
+            self._write_set[key] = value
+            return
+        if key not in self._undo_log:
+            if self._versioned:
+                self._store.begin_write(key)
+            self._undo_log[key] = self._store.get(key)
+            self._undo_order.append(key)
+        self._store.put(key, value)
 
     def release_and_grant_locks(self):
         """
         Releases all locks acquired by the transaction and grants them to the
         next transactions in the queue. This is a helper method that is called
-        during transaction commits or aborts. 
+        during transaction commits or aborts.
 
         Hint: you can use self._acquired_locks to get a list of locks acquired
         by the transaction.
@@ -268,104 +1256,157 @@ class TransactionHandler:
 
         @param self: the transaction handler.
         """
+        with self._latch:
+            woken = self._release_locks()
+        self._wake(woken)
+
+    def _release_locks(self):
+        """
+        Releases all locks of the transaction, granting them to the requests
+        waiting for them, and returns the handlers that were granted a lock.
+        Must be called with self._latch held.
+        """
+        woken = []
+        #Leave the wait queue first, so that nobody is granted behind us
+        self._leave_queue(woken)
+        for key in self._acquired_locks:
+            self._release(key, woken)
+        self._reset()
+        return woken
+
+    def _leave_queue(self, woken):
         """
-        1) The first xact that wants an X lock - and no other xacts
-        2) The first n consecutive xacts that want S locks. This set will end at the 
-    first xact that wants a X lock - or at the end of the queue
+        Withdraws the request the transaction is waiting for, if any,
+        granting the requests queued behind it that no longer have to wait.
+        With stripes, the request may have been granted in the meantime.
         """
-        
-        # release the transaction from grantedGroup
         if self._desired_lock is not None:
-           waitingKey = self._desired_lock[0]
-           waitingTransaction = self._desired_lock[1]
-           idx = self._lock_table[waitingKey][1].index(waitingTransaction)
-           #release the transaction from grantGroup
-           del self._lock_table[waitingKey][0][idx]
-
-
-        #Releases all locks acquired by the transaction and grants them to the
-        #next transactions in the queue.  _acquired_locks:[ [key, [self, 's']], [key, [self, 's']], ...]
-        for l in self._acquired_locks:
-            key = l[0] 
-            trans = l[1] 
-            
-            #if there is other transaction sharing the current lock, 
-            if len(self._lock_table[key][0])>1:
-                #release the lock, and the transaction from grantedGroup
-                idx = self._lock_table[key][0].index(trans)
-                del self._lock_table[key][0][idx]
-                #Check if the one left is able to be upgraded
-                if len(self._lock_table[key][0]) == 1: #[ [['s', self]] , [] ]
-                    transaction = self._lock_table[key][0][0]
-                    mode = transaction[0]
-                    handler = transaction[1]
-                    #if transaction is shared and it is also waiting for exclusive lock,
-                    if mode == 's' and ['e' , handler] in  self._lock_table[key][1]:
-                        #delete it from waiting group
-                        idx = self._lock_table[key][1].index(['e', handler])
-                        del self._lock_table[key][1][idx]
-                        #update grantedGroup in self lock_table
-                        self._lock_table[key][0] = [ ['e', handler] ]
-                        #update _acquired_locks
-                        acIndex = handler._acquired_locks.index([key, ['s', handler]])
-                        handler._acquired_locks[acIndex][1][0] = 'e'
-           
-            #if other transation are not sharing this lock
-            else:
-                waitingGroup = self._lock_table[key][1]
-                #if there is no waiting group
-                if len(waitingGroup)== 0:
-                    self._lock_table[key] = [ [],[] ]
-                #if there is waiting group
-                else:
-                    #if the first dequeued one is waiting for exclusive lock, 
-                    #we grant exclusive lock to this one, and update the acquiring handler 
-                    if waitingGroup[0][0] == 'e':
-                        waitingTransaction  = self._lock_table[key][1].pop()
-                        waitingHandler = waitingTransaction[1]
-                        self._lock_table[key][0] = [waitingTransaction]
-                        waitingHandler._acquired_locks.append([key, waitingTransaction])
-                    #if the first dequeued one is waiting for shared lock, 
-                    #find new grantedGroup
-                    else:
-                        numReaders = 0;
-                        self._lock_table[key][0] = []
-                        for t in waitingGroup:
-                            if t[0] == 'e':
-                                break
-                            #add to grantedGroup
-                            self._lock_table[key][0].append(t)
-                            #update 
-                            t[1]._acquired_locks.append( [key, t])
-                            numReaders+=1
-                        for i in range(numReaders):
-                            self._lock_table[key][1].pop()
-
+            xid = self._xid
+            key, mode = self._desired_lock[:2]
+            self._desired_lock = None
+            stripe = self._manager.stripe_of(key)
+            with stripe.mutex:
+                entry = self._lock_table[key]
+                held = entry.granted.get(xid)
+                if held is None or mode not in _COVERS[held]:
+                    entry.waiters.remove((mode, self))
+                    entry.upgrades.pop(xid, None)
+                    stripe.waits_for.stop_waiting(xid)
+                    if held is None:
+                        granted = len(woken)
+                        entry.grant_waiters(key, stripe.waits_for, woken)
+                        if stripe.stats is not None and len(woken) > granted:
+                            stripe.note_waits(key, woken[granted:])
+                        stripe.reclaim_entry(key, entry)
+
+    def _reset(self):
+        """
+        Forgets the transaction's locks and writes once they are released.
+        """
+        self._undo_log = {}
+        self._undo_order = []
+        self._write_set = {}
+        self._acquired_locks = {}
+        self._fine_locks = {}
+        self._fine_writes = {}
+        self._result = None
+        if self._snapshot is not None:
+            self._store.close_snapshot(self._snapshot)
+            self._snapshot = None
+        self._manager.transactions.pop(self._xid, None)
+
+    def _release(self, key, woken):
+        """
+        Releases the lock held on @key and grants it to the requests waiting
+        for it, appending their handlers to @woken.
+        """
+        stripe = self._manager.stripe_of(key)
+        with stripe.mutex:
+            entry = self._lock_table[key]
+            entry.release(self._xid)
+            if entry.waiters:
+                stripe.waits_for.remove_holder(entry.waiters, self._xid)
+                granted = len(woken)
+                entry.grant_waiters(key, stripe.waits_for, woken)
+                if stripe.stats is not None and len(woken) > granted:
+                    stripe.note_waits(key, woken[granted:])
+            stripe.reclaim_entry(key, entry)
+
+    def _wake(self, woken):
+        """
+        Finishes the operations that were waiting for the locks we released.
+        """
+        for handler in woken:
+            handler._lock_granted()
 
+    def commit(self):
+        """
+        Commits the transaction: applies its deferred writes, if any, tells a
+        VersionedStore about the commit, then releases its locks and finishes
+        the operations that were waiting for them. A transaction the lock
+        manager has doomed is aborted instead.
 
-        self._undo_log = []                    
-        self._acquired_locks = []
+        @param self: the transaction handler.
 
-    def commit(self):
+        @return: returns 'Transaction Completed', or 'Deadlock Abort' if the
+        lock manager has aborted the transaction.
         """
-        Commits the transaction.
+        with self._latch:
+            if self._doomed:
+                return self.abort(DEADLOCK)
+            self._commit_writes()
+            woken = self._release_locks()
+        self._wake(woken)
+        return 'Transaction Completed'
+
+    def _commit_writes(self):
+        if self._write_set:
+            self._apply_write_set()
+        if self._versioned and self._undo_order:
+            self._store.commit_writes(self._undo_order)
 
-        Note: This method is already implemented for you, and you only need to
-        implement the subroutine release_locks().
+    def prepare(self):
+        """
+        The first phase of a commit that spans several lock managers, see
+        lockpartitions.py. Once it returns True, the lock manager no longer
+        aborts the transaction on its own, so that commit() succeeds.
 
         @param self: the transaction handler.
 
-        @return: returns 'Transaction Completed'
+        @return: False if the lock manager has already aborted the
+        transaction, True otherwise.
         """
-        self.release_and_grant_locks()
-        return 'Transaction Completed'
+        with self._latch:
+            if self._doomed:
+                return False
+            #Out of reach of the prevention policies and lock wait timeouts
+            self._manager.transactions.pop(self._xid, None)
+            return True
 
-    def abort(self, mode):
+    def _apply_write_set(self):
+        """
+        Applies the deferred writes to the store in one batch, while the
+        transaction still holds their locks.
         """
-        Aborts the transaction.
+        items = list(self._write_set.items())
+        if self._versioned:
+            for key, value in items:
+                self._store.begin_write(key)
+        put_many = getattr(self._store, 'put_many', None)
+        if put_many is not None:
+            put_many(items)
+        else:
+            for key, value in items:
+                self._store.put(key, value)
+        if self._versioned:
+            self._store.commit_writes(self._write_set)
 
-        Note: This method is already implemented for you, and you only need to
-        implement the subroutine release_locks().
+    def abort(self, mode):
+        """
+        Aborts the transaction: undoes its writes, releases its locks and
+        finishes the operations that were waiting for them. A deadlock abort
+        of a waiting transaction is counted in the lock stats, and a doomed
+        transaction is removed from the lock manager's doomed set.
 
         @param self: the transaction handler.
         @param mode: mode can either be USER or DEADLOCK. If mode == USER, then
@@ -376,21 +1417,39 @@ class TransactionHandler:
         @return: if mode == USER, returns 'User Abort'. If mode == DEADLOCK,
         returns 'Deadlock Abort'.
         """
-        while (len(self._undo_log) > 0):
-            k,v = self._undo_log.pop()
-            self._store.put(k, v)
-        self.release_and_grant_locks()
+        with self._latch:
+            if mode == DEADLOCK and self._desired_lock is not None:
+                self._manager.note_abort(self._desired_lock[0])
+            woken = self._rollback()
+        self._wake(woken)
+        if self._doomed:
+            self._manager.forget_doomed([self._xid])
         if (mode == USER):
             return 'User Abort'
         else:
             return 'Deadlock Abort'
 
+    def _rollback(self):
+        """
+        Undoes the writes of the transaction and releases its locks. Must be
+        called with self._latch held; returns the handlers to wake.
+        """
+        self._undo_writes()
+        return self._release_locks()
+
+    def _undo_writes(self):
+        #One write per key, restoring its value from before the transaction
+        for k in reversed(self._undo_order):
+            self._store.put(k, self._undo_log[k])
+        if self._versioned and self._undo_order:
+            self._store.abort_writes(self._undo_order)
+
     def check_lock(self):
         """
         If perform_get() or perform_put() returns None, then the transaction is
         waiting to acquire a lock. This method is called periodically to check
         if the lock has been granted due to commit or abort of other
-        transactions. If so, then this method returns the string that would 
+        transactions. If so, then this method returns the string that would
         have been returned by perform_get() or perform_put() if the method had
         not been blocked. Otherwise, this method returns None.
 
@@ -413,6 +1472,11 @@ class TransactionHandler:
         Hint: remember to update self._undo_log so that we can undo all the
         changes if the transaction later gets aborted.
 
+        Note: the blocked operation is performed as soon as the lock is
+        granted, by the transaction that released it. Servers that register a
+        grant callback, or drain TransactionCoordinator.drain_ready(), do not
+        need to poll; this method only hands back the saved result.
+
         @param self: the transaction handler.
 
         @return: if the lock has been granted, then returns whatever would be
@@ -420,25 +1484,9 @@ class TransactionHandler:
         successfully acquired the lock. If the lock has not been granted,
         returns None.
         """
-
-        key = self._desired_lock[0]
-        transaction = self._desired_lock[1]
-        mode = transaction[0]
-        value = self._desired_lock[2]
-        
-
-        if[key, transaction] in self._acquired_locks:
-            self._desired_lock = None
-            if mode == 'e':
-                return self.perform_put(key, value)
-            else:
-                return self.perform_get(key)
-        else:
-            return None
-        
-
-
-
+        result = self._result
+        self._result = None
+        return result
 
 
 
@@ -450,28 +1498,380 @@ The transaction coordinator has access to the following object:
 self._lock_table: see description from Part I
 """
 
+def find_deadlocked_components(waitsForGraph, roots):
+    """
+    Finds the strongly connected components of a waits-for graph that contain
+    a cycle, using an iterative version of Tarjan's algorithm so that long
+    wait chains neither take quadratic time nor hit the recursion limit.
+
+    @param waitsForGraph: maps the xid of every waiting transaction to the
+    xids it waits for. Transactions that are not waiting have no entry.
+    @param roots: the xids to search from. Only the part of the graph
+    reachable from them is visited, in one linear pass.
+
+    @return: a list of deadlocked components, each a list of xids.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    onStack = set()
+    components = []
+    for root in roots:
+        if root in index or root not in waitsForGraph:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        onStack.add(root)
+        work = [(root, iter(waitsForGraph[root]))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    onStack.add(child)
+                    work.append((child, iter(waitsForGraph.get(child, ()))))
+                    break
+                elif child in onStack and index[child] < lowlink[node]:
+                    lowlink[node] = index[child]
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    if lowlink[node] < lowlink[parent]:
+                        lowlink[parent] = lowlink[node]
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        xid = stack.pop()
+                        onStack.discard(xid)
+                        component.append(xid)
+                        if xid == node:
+                            break
+                    #Nobody waits for itself, so a cycle needs two members
+                    if len(component) > 1:
+                        components.append(component)
+    return components
+
+"""
+The cost of aborting a transaction under each victim policy.
+"""
+_VICTIM_COSTS = {
+    YOUNGEST: lambda handler: 0,
+    FEWEST_LOCKS: lambda handler: len(handler._acquired_locks),
+    SMALLEST_UNDO_LOG: lambda handler: len(handler._undo_log) +
+                                       len(handler._write_set),
+    FEWEST_RESTARTS: lambda handler: handler._restarts,
+}
+
+class _WaitsForSnapshot(object):
+    """
+    A read-only view of the waits-for graph for the coordinator. The edges of
+    each transaction are copied under the mutex of its stripe the first time
+    they are looked at, so a check never stops the whole lock manager, and
+    only copies the part of the graph it visits.
+
+    handlers: the handler of every waiting transaction visited.
+    keys: the key every waiting transaction visited was queued on.
+    """
+
+    def __init__(self, manager):
+        self._manager = manager
+        self._edges = {}
+        self.handlers = {}
+        self.keys = {}
+
+    def get(self, xid, default=None):
+        edges = self._edges.get(xid)
+        if edges is None:
+            found = self._manager.edges_of(xid)
+            if found is None:
+                return default
+            edges, self.handlers[xid], self.keys[xid] = found
+            self._edges[xid] = edges
+        return edges
+
+    def __contains__(self, xid):
+        return self.get(xid) is not None
+
+    def __getitem__(self, xid):
+        edges = self.get(xid)
+        if edges is None:
+            raise KeyError(xid)
+        return edges
+
 class TransactionCoordinator:
 
-    def __init__(self, lock_table):
+    def __init__(self, lock_table, victim_policy=None, ready_queue=False):
+        if victim_policy is None:
+            victim_policy = DEADLOCK_VICTIM_POLICY
         self._lock_table = lock_table
+        self._manager = get_lock_manager(lock_table)
+        if ready_queue and self._manager.ready is None:
+            self._manager.ready = deque()
+        self._victim_cost = _VICTIM_COSTS[victim_policy]
+        self._victims = []
+        self._suspects = set()
+
+    def detect_all_deadlocks(self):
+        """
+        Finds every deadlocked set of transactions in the waits-for graph in
+        a single pass, and picks one transaction to abort in each of them
+        according to the coordinator's victim policy. The choice is
+        deterministic.
 
-    def dfs(self, waitsForGraph, w_xid, visited=None):
+        A component can contain more than one cycle, and aborting its victim
+        may leave another one behind; that cycle is then found on the next
+        call.
 
-        if w_xid not in waitsForGraph:
-            return True
-        
-        if visited is None:
-            visited = set()
+        @param self: the transaction coordinator.
 
-        if w_xid in visited:
-            return False
+        The transactions the lock manager aborted itself, to prevent a
+        deadlock or because they waited too long for a lock, are returned as
+        well. With a deadlock prevention policy, they are the only ones.
+
+        @return: a sorted list of the xids to abort, empty if there are no
+        cycles in the waits-for graph.
+        """
+        manager = self._manager
+        if manager.wait_timeouts:
+            self._expire_waits()
+        if manager.prevention is None:
+            victims = self._find_cycle_victims()
+        else:
+            victims = []
+        if not manager.doomed:
+            return victims
+        with manager.doomed_latch:
+            return sorted(manager.doomed.union(victims))
+
+    def _find_cycle_victims(self):
+        #The waits-for graph is maintained by the transaction handlers. If it
+        #has not changed since the last call, neither has the answer.
+        #A new cycle has to go through an edge added since the last call, and
+        #a cycle found before is still there until one of its members leaves
+        manager = self._manager
+        suspects = self._suspects
+        changed = False
+        for stripe in manager.stripes:
+            with stripe.mutex:
+                waitsForGraph = stripe.waits_for
+                if waitsForGraph.changed:
+                    changed = True
+                    waitsForGraph.changed = False
+                    suspects.update(waitsForGraph.dirty)
+                    waitsForGraph.dirty.clear()
+        if not changed:
+            return self._victims
+
+        snapshot = _WaitsForSnapshot(manager)
+        components = find_deadlocked_components(snapshot, sorted(suspects))
+        if manager.threaded:
+            components = [confirmed for component in components
+                          for confirmed in self._confirm(snapshot, component)]
+        suspects.clear()
+        for component in components:
+            suspects.update(component)
+        self._victims = sorted(self._pick_victim(snapshot, component)
+                               for component in components)
+        return self._victims
+
+    def _expire_waits(self):
+        """
+        Aborts the transactions that have waited for a lock for longer than
+        their lock wait timeout.
+        """
+        manager = self._manager
+        now = time.time()
+        for handler in list(manager.transactions.values()):
+            timeout = handler._lock_wait_timeout
+            desired = handler._desired_lock
+            if (timeout is not None and desired is not None
+                    and now - handler._wait_started > timeout
+                    and handler._doom()):
+                manager.note_abort(desired[0], timeout=True)
+
+    def _confirm(self, snapshot, component):
+        """
+        The edges of a snapshot are read one stripe at a time, so a member of
+        a cycle may have left it, by aborting, after its edges were read.
+        Rereads the edges of @component with the mutexes of all the stripes
+        involved held, and returns the deadlocked components still among them.
+        """
+        manager = self._manager
+        members = set(component)
+        stripes = [manager.stripes[i] for i in sorted(set(
+            manager.stripe_index(snapshot.keys[xid]) for xid in component))]
+        for stripe in stripes:
+            stripe.mutex.acquire()
+        try:
+            edges = {}
+            for xid in component:
+                waitsFor = manager.stripe_of(snapshot.keys[xid]).waits_for
+                if xid in waitsFor.edges:
+                    edges[xid] = [g for g in waitsFor.edges[xid]
+                                  if g in members]
+        finally:
+            for stripe in reversed(stripes):
+                stripe.mutex.release()
+        return find_deadlocked_components(edges, sorted(edges))
+
+    def group_release(self, commits=(), aborts=(), mode=USER):
+        """
+        Commits the transactions of the handlers in @commits and aborts those
+        in @aborts in one batch, e.g. all the transactions that finished in
+        one iteration of the server loop. The locks of the whole batch are
+        released first, taking each stripe's mutex once, and then the waiters
+        of each affected key are granted in FIFO order in a single pass,
+        rather than once per finishing transaction that held the key.
 
-        visited.add(w_xid)
+        @param self: the transaction coordinator.
+        @param commits, aborts: the handlers of the finishing transactions.
+        @param mode: the abort mode of @aborts, USER (the default) or DEADLOCK.
 
-        for g in waitsForGraph[w_xid]:
-            if self.dfs(waitsForGraph, g, visited) == False:
-                return False
-        return True
+        @return: a dict mapping the xid of every finishing transaction to
+        what its commit() or abort() would have returned. A transaction the
+        lock manager already aborted is aborted rather than committed.
+        """
+        manager = self._manager
+        lockTable = self._lock_table
+        finishing = sorted([(handler._xid, handler, True)
+                            for handler in commits]
+                           + [(handler._xid, handler, False)
+                              for handler in aborts])
+        results = {}
+        doomed = []
+        woken = []
+        #Maps the index of every stripe involved to the keys of the stripe
+        #to release, and each key to the xids releasing it
+        released = {}
+        #In xid order, as the prevention policies latch younger transactions
+        #while holding the latch of an older one
+        for xid, handler, commit in finishing:
+            handler._latch.acquire()
+        try:
+            for xid, handler, commit in finishing:
+                if handler._doomed:
+                    doomed.append(xid)
+                if commit and not handler._doomed:
+                    handler._commit_writes()
+                    results[xid] = 'Transaction Completed'
+                else:
+                    if (handler._desired_lock is not None
+                            and (commit or mode == DEADLOCK)):
+                        manager.note_abort(handler._desired_lock[0])
+                    handler._undo_writes()
+                    if commit or mode == DEADLOCK:
+                        results[xid] = 'Deadlock Abort'
+                    else:
+                        results[xid] = 'User Abort'
+                handler._leave_queue(woken)
+            for xid, handler, commit in finishing:
+                for key in handler._acquired_locks:
+                    keys = released.setdefault(manager.stripe_index(key), {})
+                    keys.setdefault(key, []).append(xid)
+            for index in sorted(released):
+                stripe = manager.stripes[index]
+                with stripe.mutex:
+                    for key, xids in released[index].items():
+                        entry = lockTable[key]
+                        for xid in xids:
+                            entry.release(xid)
+                            if entry.waiters:
+                                stripe.waits_for.remove_holder(entry.waiters,
+                                                               xid)
+                        if entry.waiters:
+                            granted = len(woken)
+                            entry.grant_waiters(key, stripe.waits_for, woken)
+                            if stripe.stats is not None and \
+                                    len(woken) > granted:
+                                stripe.note_waits(key, woken[granted:])
+                        stripe.reclaim_entry(key, entry)
+            for xid, handler, commit in finishing:
+                handler._reset()
+        finally:
+            for xid, handler, commit in reversed(finishing):
+                handler._latch.release()
+        for handler in woken:
+            handler._lock_granted()
+        if doomed:
+            manager.forget_doomed(doomed)
+        return results
+
+    def waits_for_edges(self):
+        """
+        Returns a copy of the waits-for graph, so that the graphs of several
+        lock managers can be merged, see lockpartitions.py.
+
+        @param self: the transaction coordinator.
+
+        @return: a dict mapping the xid of every waiting transaction to the
+        sorted list of xids it waits for; empty with a deadlock prevention
+        policy.
+        """
+        manager = self._manager
+        edges = {}
+        if manager.prevention is not None:
+            return edges
+        for stripe in manager.stripes:
+            with stripe.mutex:
+                for xid, holders in stripe.waits_for.edges.items():
+                    edges[xid] = sorted(holders)
+        return edges
+
+    def drain_ready(self):
+        """
+        Returns the handlers whose blocked operation has completed since the
+        last call, in the order they were granted their locks. Their
+        check_lock() returns the result. Only available if the coordinator was
+        created with ready_queue=True; handlers with a grant callback are
+        notified through it instead.
+
+        @param self: the transaction coordinator.
+        """
+        ready = self._manager.ready
+        handlers = []
+        while ready:
+            handlers.append(ready.popleft())
+        return handlers
+
+    def live_lock_entries(self):
+        """
+        Returns the number of keys that currently have a lock table entry,
+        i.e. that some transaction holds or waits for a lock on.
+
+        @param self: the transaction coordinator.
+        """
+        return self._manager.live_entries()
+
+    def lock_stats(self, reset=False):
+        """
+        Returns the contention statistics of every key that was locked since
+        they were last reset, see LOCK_STATS.
+
+        @param self: the transaction coordinator.
+        @param reset: whether to start counting afresh.
+
+        @return: a dict mapping each key to a copy of its KeyStats; empty if
+        LOCK_STATS is off.
+        """
+        snapshot = {}
+        for stripe in self._manager.stripes:
+            if stripe.stats is None:
+                continue
+            with stripe.mutex:
+                if reset:
+                    snapshot.update(stripe.stats)
+                    stripe.stats = {}
+                else:
+                    for key, stats in stripe.stats.items():
+                        snapshot[key] = stats.copy()
+        return snapshot
+
+    def _pick_victim(self, snapshot, component):
+        handlers = snapshot.handlers
+        cost = self._victim_cost
+        return min(component, key=lambda xid: (cost(handlers[xid]), -xid))
 
     def detect_deadlocks(self):
         """
@@ -492,29 +1892,15 @@ class TransactionCoordinator:
 
         Note: in this method, you only need to find and return the xid of a
         transaction that needs to be aborted. You do not have to perform the
-        actual abort.
+        actual abort. Use detect_all_deadlocks() to get the victims of every
+        cycle at once.
 
         @param self: the transaction coordinator.
 
         @return: If there are no cycles in the waits-for graph, returns None.
         Otherwise, returns the xid of a transaction in a cycle.
         """
-        
-        #Construct waitsForGraph using Dictionary
-        waitsForGraph = {}                                  
-        for key in self._lock_table.keys():                 
-            for w in self._lock_table[key][1]:         
-                for g in self._lock_table[key][0]:
-                    w_xid = w[1]._xid
-                    g_xid = g[1]._xid
-                    if w_xid not in waitsForGraph.keys():
-                        waitsForGraph[w_xid] = [g_xid]
-                    else:
-                        waitsForGraph[w_xid].append(g_xid)
-
-        #Detect cycle
-        for w_xid in waitsForGraph.keys():
-            if self.dfs(waitsForGraph, w_xid) == False:
-                return w_xid
+        victims = self.detect_all_deadlocks()
+        if victims:
+            return victims[0]
         return None
-